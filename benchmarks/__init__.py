@@ -0,0 +1,13 @@
+"""
+Numerauto benchmarks
+
+Generates synthetic datasets with the layout of the Numerai datasets (see
+benchmarks.synthetic), and measures the performance of the data checks, the
+model training and prediction path, the prediction statistics and the report
+writing of Numerauto on them (see benchmarks.suite). Results are written as
+JSON, so that they can be compared between versions.
+
+Run the benchmarks from the repository root with:
+
+    python -m benchmarks --output results.json
+"""
@@ -0,0 +1,67 @@
+"""
+Command line interface of the Numerauto benchmarks, see benchmarks.suite.
+"""
+
+import sys
+import json
+import logging
+import argparse
+import tempfile
+
+from .suite import BenchmarkSuite
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='Benchmark Numerauto on synthetic Numerai datasets.')
+    parser.add_argument('--eras', type=int, default=120, help='number of train eras (default: 120)')
+    parser.add_argument('--rows-per-era', type=int, default=500,
+                        help='number of rows per train and validation era (default: 500)')
+    parser.add_argument('--features', type=int, default=310, help='number of feature columns (default: 310)')
+    parser.add_argument('--tournaments', default='kazutsugi',
+                        help='comma-separated tournament names, which each get a target column (default: kazutsugi)')
+    parser.add_argument('--validation-eras', type=int, default=12, help='number of validation eras (default: 12)')
+    parser.add_argument('--test-rows', type=int, default=5000, help='number of test rows (default: 5000)')
+    parser.add_argument('--live-rows', type=int, default=5000, help='number of live rows (default: 5000)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data (default: 0)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of times each benchmark is run (default: 3)')
+    parser.add_argument('--benchmarks', default=None,
+                        help='comma-separated patterns of the benchmarks to run, e.g. "check_dataset.*" (default: all)')
+    parser.add_argument('--directory', default=None,
+                        help='working directory, in which generated datasets are kept for later runs '
+                             '(default: a temporary directory)')
+    parser.add_argument('--output', default=None, help='file to write the JSON results to (default: stdout)')
+    parser.add_argument('--verbose', action='store_true', help='log progress to stderr')
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.basicConfig(format='%(asctime)s [%(levelname)8s] %(name)s: %(message)s', level=logging.INFO)
+
+    parameters = {'eras': args.eras,
+                  'rows_per_era': args.rows_per_era,
+                  'features': args.features,
+                  'tournaments': args.tournaments.split(','),
+                  'validation_eras': args.validation_eras,
+                  'test_rows': args.test_rows,
+                  'live_rows': args.live_rows,
+                  'seed': args.seed}
+    patterns = args.benchmarks.split(',') if args.benchmarks else None
+
+    if args.directory is not None:
+        suite = BenchmarkSuite(args.directory, parameters, args.repeat)
+        suite.run(patterns)
+    else:
+        with tempfile.TemporaryDirectory(prefix='numerauto-benchmark-') as directory:
+            suite = BenchmarkSuite(directory, parameters, args.repeat)
+            suite.run(patterns)
+
+    results = json.dumps(suite.get_results(), indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            fp.write(results + '\n')
+    else:
+        print(results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
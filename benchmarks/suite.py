@@ -0,0 +1,274 @@
+"""
+Benchmark suite
+
+Each benchmark is a function that is called 'repeat' times and measured with
+numerauto.utils.Measurement. Benchmarks run on two synthetic rounds: round 1,
+and round 2 which only differs in its live rows. Like in the daemon, the
+datasets are converted to the columnar cache before the data checks and the
+event handlers are measured.
+
+Benchmarks:
+- convert_dataset: conversion of the training data CSV file to the cache.
+- compute_fingerprints: fingerprints of the training data CSV file.
+- check_dataset.<method>.live: check for new live data between the rounds.
+- check_dataset.<method>.training: check for new training data between the rounds.
+- trainer.load: loading the training data with Numerauto.load_dataset.
+- trainer.fit: SKLearnModelTrainer.on_new_training_data.
+- trainer.predict: SKLearnModelTrainer.on_new_tournament_data.
+- statistics: PredictionStatisticsGenerator.on_new_tournament_data.
+- report_writer: BasicReportWriter.on_cleanup.
+"""
+
+import os
+import sys
+import json
+import shutil
+import fnmatch
+import logging
+import platform
+import datetime
+import statistics
+from pathlib import Path
+
+import numpy as np
+
+import numerauto
+from numerauto import Numerauto, datasets
+from numerauto.numerauto import nested_defaultdict
+from numerauto.eventhandlers import SKLearnModelTrainer, PredictionStatisticsGenerator, BasicReportWriter
+from numerauto.predictions import PredictionRegistry
+from numerauto.utils import Measurement, check_dataset
+
+from .synthetic import generate_dataset
+
+
+logger = logging.getLogger(__name__)
+
+
+RESULTS_VERSION = 1
+CHECK_DATASET_METHODS = ['fingerprint', 'chunked', 'full']
+
+
+class LinearModel:
+    """
+    Least squares linear model with the sklearn fit/predict API, which only
+    depends on numpy so that the benchmark results do not depend on the
+    installed scikit-learn version.
+    """
+
+    def fit(self, x, y):
+        x = np.column_stack([x, np.ones(len(x), dtype=x.dtype)])
+        self.coef_ = np.linalg.lstsq(x, y, rcond=None)[0]
+        return self
+
+    def predict(self, x):
+        return np.clip(x @ self.coef_[:-1] + self.coef_[-1], 0, 1)
+
+
+def _summarize(measurements):
+    """ Summarize the measurements of the repeats of a benchmark """
+
+    wall_times = [m.wall_time for m in measurements]
+    cpu_times = [m.cpu_time for m in measurements]
+    peak_rss = [m.peak_rss for m in measurements if m.peak_rss is not None]
+    peak_rss_increase = [m.peak_rss_increase for m in measurements if m.peak_rss_increase is not None]
+
+    return {'repeat': len(measurements),
+            'wall_time': {'min': min(wall_times),
+                          'median': statistics.median(wall_times),
+                          'max': max(wall_times)},
+            'cpu_time': {'min': min(cpu_times),
+                         'median': statistics.median(cpu_times),
+                         'max': max(cpu_times)},
+            'peak_rss': max(peak_rss) if peak_rss else None,
+            'peak_rss_increase': max(peak_rss_increase) if peak_rss_increase else None}
+
+
+class BenchmarkSuite:
+    """
+    Benchmarks of Numerauto on synthetic datasets.
+
+    Attributes:
+        directory: Working directory that contains the datasets, models,
+                   predictions and reports.
+        parameters: Parameters of the synthetic datasets (see
+                    benchmarks.synthetic.generate_dataset)
+        repeat: Number of times each benchmark is executed.
+        results: Summarized results by benchmark name.
+    """
+
+    def __init__(self, directory, parameters, repeat=3):
+        self.directory = Path(directory)
+        self.parameters = parameters
+        self.repeat = repeat
+        self.results = {}
+
+    def get_filename(self, round_number, filename):
+        """ Get the filename of a data file of a synthetic round """
+
+        return self.directory / 'data' / 'numerai_dataset_{}'.format(round_number) / filename
+
+    def prepare_datasets(self):
+        """
+        Generate the synthetic datasets of round 1 and 2, unless datasets with
+        the same parameters already exist in the working directory.
+        """
+
+        parameters_filename = self.directory / 'parameters.json'
+        try:
+            with open(parameters_filename, 'r') as fp:
+                if json.load(fp) == self.parameters:
+                    logger.info('Using existing datasets in %s', self.directory)
+                    return
+        except (FileNotFoundError, ValueError):
+            pass
+
+        if os.path.isdir(self.directory / 'data'):
+            shutil.rmtree(self.directory / 'data')
+        for round_number in [1, 2]:
+            generate_dataset(self.get_filename(round_number, ''), live_seed=round_number, **self.parameters)
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(parameters_filename, 'w') as fp:
+            json.dump(self.parameters, fp)
+
+    def _remove_cache(self, filename):
+        """ Remove the cache and fingerprints of a dataset file """
+
+        if os.path.isdir(datasets.get_cache_path(filename)):
+            shutil.rmtree(datasets.get_cache_path(filename))
+        if os.path.isfile(datasets.get_fingerprint_path(filename)):
+            os.remove(datasets.get_fingerprint_path(filename))
+
+    def measure(self, name, function, setup=None, patterns=None):
+        """
+        Measure a benchmark and store its summarized results.
+
+        Args:
+            name: Name of the benchmark.
+            function: Function to measure, which takes no arguments.
+            setup: Function that is called before every repeat, which is not
+                   measured (default: None)
+            patterns: Only measure the benchmark if its name matches one of
+                      these patterns (default: None, i.e. always)
+        """
+
+        if patterns and not any(fnmatch.fnmatchcase(name, x) for x in patterns):
+            return
+
+        logger.info('Running benchmark %s', name)
+        measurements = []
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            measurement = Measurement()
+            with measurement:
+                function()
+            measurements.append(measurement)
+
+        self.results[name] = _summarize(measurements)
+        logger.info('Benchmark %s: %.3f seconds', name, self.results[name]['wall_time']['median'])
+
+    def _create_numerauto(self):
+        """ Create a Numerauto instance with the benchmarked event handlers, ready to process round 2 """
+
+        na = Numerauto(config={'data_directory': self.directory / 'data',
+                               'model_directory': self.directory / 'models',
+                               'prediction_directory': self.directory / 'predictions',
+                               'report_directory': self.directory / 'reports'})
+
+        na.add_event_handler(SKLearnModelTrainer('trainer', LinearModel))
+        na.add_event_handler(PredictionStatisticsGenerator('statistics', 'trainer.csv', dependencies=['trainer']))
+        na.add_event_handler(BasicReportWriter('report_writer'))
+
+        na.tournaments = {na.tournament_id: self.parameters['tournaments'][0]}
+        na.persistent_state = {'last_round_processed': 1, 'last_round_trained': 2,
+                               'tournament_state': {na.tournament_id: {'last_round_processed': 1,
+                                                                       'last_round_trained': 2}}}
+        na._on_start()
+
+        na.round_number = 2
+        na.report = nested_defaultdict()
+        na.predictions = PredictionRegistry(na.submit_background_task)
+        return na
+
+    def run(self, patterns=None):
+        """
+        Run the benchmarks.
+
+        Args:
+            patterns: Only run the benchmarks of which the name matches one of
+                      these patterns (default: None, i.e. all benchmarks)
+
+        Returns:
+            Dictionary with the summarized results by benchmark name.
+        """
+
+        self.prepare_datasets()
+
+        training_filename = self.get_filename(2, 'numerai_training_data.csv')
+        self.measure('convert_dataset', lambda: datasets.convert_dataset(training_filename),
+                     setup=lambda: self._remove_cache(training_filename), patterns=patterns)
+        self.measure('compute_fingerprints', lambda: datasets.compute_fingerprints(training_filename),
+                     patterns=patterns)
+
+        # Convert all datasets, as is done by Numerauto after downloading
+        for round_number in [1, 2]:
+            for filename in ['numerai_training_data.csv', 'numerai_tournament_data.csv']:
+                datasets.convert_dataset(self.get_filename(round_number, filename))
+
+        for method in CHECK_DATASET_METHODS:
+            self.measure('check_dataset.{}.live'.format(method),
+                         lambda: check_dataset(self.get_filename(1, 'numerai_tournament_data.csv'),
+                                               self.get_filename(2, 'numerai_tournament_data.csv'),
+                                               data_type='live', method=method),
+                         patterns=patterns)
+            self.measure('check_dataset.{}.training'.format(method),
+                         lambda: check_dataset(self.get_filename(1, 'numerai_training_data.csv'),
+                                               self.get_filename(2, 'numerai_training_data.csv'),
+                                               method=method),
+                         patterns=patterns)
+
+        na = self._create_numerauto()
+        trainer, statistics_generator, report_writer = na.event_handlers
+        try:
+            # Background tasks such as writing the model are waited for
+            # before each repeat, without being measured
+            wait = lambda: na.wait_for_background_tasks()
+
+            self.measure('trainer.load', lambda: na.load_dataset(2, 'numerai_training_data.csv'),
+                         patterns=patterns)
+            self.measure('trainer.fit', lambda: trainer.on_new_training_data(2), setup=wait, patterns=patterns)
+            # Predicting and the statistics require a model and predictions
+            if 'trainer.fit' not in self.results:
+                trainer.on_new_training_data(2)
+            self.measure('trainer.predict', lambda: trainer.on_new_tournament_data(2), setup=wait,
+                         patterns=patterns)
+            if 'trainer.predict' not in self.results:
+                trainer.on_new_tournament_data(2)
+            self.measure('statistics', lambda: statistics_generator.on_new_tournament_data(2), setup=wait,
+                         patterns=patterns)
+            self.measure('report_writer', lambda: report_writer.on_cleanup(2), setup=wait, patterns=patterns)
+            wait()
+        finally:
+            na._on_shutdown()
+
+        return self.results
+
+    def get_results(self):
+        """
+        Get the results with information about the environment, as a
+        JSON-serializable dictionary.
+        """
+
+        return {'version': RESULTS_VERSION,
+                'numerauto_version': numerauto.__version__,
+                'python_version': platform.python_version(),
+                'numpy_version': np.__version__,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'command_line': sys.argv,
+                'parameters': self.parameters,
+                'repeat': self.repeat,
+                'benchmarks': self.results}
@@ -0,0 +1,174 @@
+"""
+Synthetic Numerai datasets
+
+Generates numerai_training_data.csv and numerai_tournament_data.csv files with
+the layout of the Numerai datasets: an id, era and data_type column, feature
+columns with the quantized values 0, 0.25, 0.5, 0.75 and 1, and one target
+column per tournament. The training data contains the train eras, the
+tournament data contains the validation eras, and test and live rows in era
+'eraX' without targets. The targets depend on a few features, so that trained
+models have a non-trivial validation correlation.
+
+Data is generated from a seed, so the same parameters give the same files.
+Datasets of consecutive rounds can be simulated by generating the same
+dataset with a different live_seed, which only changes the live rows.
+"""
+
+import os
+import logging
+from pathlib import Path
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+FEATURE_GROUPS = ['intelligence', 'charisma', 'strength', 'dexterity', 'constitution', 'wisdom']
+# Quantized feature and target values, formatted with a fixed width
+QUANTIZED_VALUES = [b'0.00', b'0.25', b'0.50', b'0.75', b'1.00']
+# Probabilities of the quantized feature values
+FEATURE_PROBABILITIES = [0.05, 0.2, 0.5, 0.2, 0.05]
+# Number of features the targets depend on
+SIGNAL_FEATURES = 10
+# Number of rows generated and written at a time
+SYNTHETIC_CHUNKSIZE = 10000
+
+
+def get_feature_names(n_features):
+    """
+    Get the names of the feature columns, which are divided over the feature
+    groups like in the Numerai datasets, e.g. 'feature_intelligence1'.
+
+    Args:
+        n_features: Number of features.
+
+    Returns:
+        List of feature column names.
+    """
+
+    per_group = -(-n_features // len(FEATURE_GROUPS))
+    names = ['feature_{}{}'.format(group, i + 1) for group in FEATURE_GROUPS for i in range(per_group)]
+    return names[:n_features]
+
+
+class _RowGenerator:
+    """ Generates blocks of rows with features and targets for the synthetic datasets """
+
+    def __init__(self, n_features, tournaments, seed):
+        rng = np.random.default_rng(seed)
+        self.n_features = n_features
+        self.tournaments = list(tournaments)
+        self.signal = rng.choice(n_features, size=min(SIGNAL_FEATURES, n_features), replace=False)
+        self.weights = rng.normal(size=len(self.signal))
+
+    def generate(self, rng, n_rows, with_targets):
+        """
+        Generate feature codes (0-4) and target codes (0-4, or -1 if missing)
+        for a block of rows.
+        """
+
+        features = rng.choice(5, size=(n_rows, self.n_features), p=FEATURE_PROBABILITIES).astype(np.uint8)
+        if not with_targets:
+            return features, np.full((n_rows, len(self.tournaments)), -1, dtype=np.int8)
+
+        latent = (features[:, self.signal] - 2.0) @ self.weights
+        latent /= max(np.std(latent), 1e-9)
+        targets = np.empty((n_rows, len(self.tournaments)), dtype=np.int8)
+        for i in range(len(self.tournaments)):
+            score = latent + rng.normal(scale=4.0, size=n_rows)
+            targets[:, i] = np.digitize(score, np.quantile(score, [0.05, 0.25, 0.75, 0.95]))
+        return features, targets
+
+
+def _make_ids(start, n_rows):
+    """ Generate unique ids of the form 'n' + 15 hexadecimal digits """
+
+    # Multiplication by an odd number is a permutation modulo 16**15
+    index = (np.arange(start, start + n_rows, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)) % np.uint64(16**15)
+    return ['n{:015x}'.format(x) for x in index.tolist()]
+
+
+def _write_rows(fp, ids, eras, data_type, features, targets):
+    """ Write a block of rows to a CSV file """
+
+    values = np.array([[ord(',')] + list(x) for x in QUANTIZED_VALUES], dtype=np.uint8)
+    feature_bytes = values[features].reshape(len(features), -1)
+    target_strings = [b',' + x for x in QUANTIZED_VALUES] + [b',']
+
+    lines = []
+    for i in range(len(ids)):
+        lines.append(b''.join([
+            '{},{},{}'.format(ids[i], eras[i], data_type).encode('ascii'),
+            feature_bytes[i].tobytes(),
+            b''.join(target_strings[t] for t in targets[i].tolist()),
+            b'\n']))
+    fp.write(b''.join(lines))
+
+
+def _write_dataset(filename, generator, feature_names, blocks):
+    """
+    Atomically write a dataset CSV file from blocks of (rng, id offset, era,
+    data_type, number of rows, with targets).
+    """
+
+    tmp_filename = '{}.tmp'.format(filename)
+    with open(tmp_filename, 'wb') as fp:
+        header = ['id', 'era', 'data_type'] + feature_names + ['target_' + x for x in generator.tournaments]
+        fp.write((','.join(header) + '\n').encode('ascii'))
+
+        for rng, id_offset, era, data_type, n_rows, with_targets in blocks:
+            for start in range(0, n_rows, SYNTHETIC_CHUNKSIZE):
+                n = min(SYNTHETIC_CHUNKSIZE, n_rows - start)
+                features, targets = generator.generate(rng, n, with_targets)
+                _write_rows(fp, _make_ids(id_offset + start, n), [era] * n, data_type, features, targets)
+
+    os.replace(tmp_filename, filename)
+
+
+def generate_dataset(directory, eras=120, rows_per_era=500, features=310, tournaments=('kazutsugi',),
+                     validation_eras=12, test_rows=5000, live_rows=5000, seed=0, live_seed=0):
+    """
+    Generate a synthetic Numerai dataset.
+
+    Args:
+        directory: Directory in which the dataset files are written, e.g.
+                   the dataset directory of a round.
+        eras: Number of train eras.
+        rows_per_era: Number of rows per train and validation era.
+        features: Number of feature columns.
+        tournaments: Names of the tournaments, which each get a target column.
+        validation_eras: Number of validation eras.
+        test_rows: Number of test rows.
+        live_rows: Number of live rows.
+        seed: Seed of all data except the live rows.
+        live_seed: Seed of the live rows.
+
+    Returns:
+        Tuple of the filenames of the training and tournament data.
+    """
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    generator = _RowGenerator(features, tournaments, seed)
+    feature_names = get_feature_names(features)
+    rng = np.random.default_rng([seed, 1])
+    live_rng = np.random.default_rng([seed, 2, live_seed])
+
+    training_filename = directory / 'numerai_training_data.csv'
+    logger.info('generate_dataset: Writing %s', training_filename)
+    _write_dataset(training_filename, generator, feature_names,
+                   [(rng, i * rows_per_era, 'era{}'.format(i + 1), 'train', rows_per_era, True)
+                    for i in range(eras)])
+
+    tournament_filename = directory / 'numerai_tournament_data.csv'
+    offset = (eras + validation_eras) * rows_per_era
+    logger.info('generate_dataset: Writing %s', tournament_filename)
+    _write_dataset(tournament_filename, generator, feature_names,
+                   [(rng, (eras + i) * rows_per_era, 'era{}'.format(eras + i + 1), 'validation', rows_per_era, True)
+                    for i in range(validation_eras)] +
+                   [(rng, offset, 'eraX', 'test', test_rows, False),
+                    (live_rng, offset + test_rows + live_seed * live_rows, 'eraX', 'live', live_rows, False)])
+
+    return training_filename, tournament_filename
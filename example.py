@@ -39,13 +39,15 @@ na.add_event_handler(SKLearnModelTrainer('linear_regression',
                                          lambda: LinearRegression()))
 
 # Generate statistics for the prediction in the numerauto report dictionary
-na.add_event_handler(PredictionStatisticsGenerator('gen1', 'linear_regression.csv'))
+na.add_event_handler(PredictionStatisticsGenerator('gen1', 'linear_regression.csv',
+                                                   dependencies=['linear_regression']))
 
 # Prediction uploader
 na.add_event_handler(PredictionUploader('linear_regression_uploader',
                                         'linear_regression.csv',
                                         'insert your publickey here',
-                                        'insert your secretkey here'))
+                                        'insert your secretkey here',
+                                        dependencies=['linear_regression']))
 
 # Report handlers: Write a simple report to file and email it
 na.add_event_handler(BasicReportWriter('writer'))
@@ -0,0 +1,259 @@
+"""
+Artifact store for Numerauto
+
+Stores objects such as trained models using pickle protocol 5. Large buffers
+(e.g. the numpy arrays of a model) are stored out-of-band as separate files
+that are memory-mapped when the object is loaded, while the pickle stream and
+small buffers are compressed with zlib. All data is stored in content-addressed
+blob files in the .blobs directory of the store, so identical models or arrays
+from different rounds are stored only once. The artifact file itself is a
+small manifest that lists its blobs, and is written atomically after all blobs
+have been written.
+
+Blobs that are no longer referenced by any artifact file, e.g. after model
+files were removed, are deleted by ArtifactStore.collect_garbage.
+
+Files written with a plain pickle.dump are still loaded by ArtifactStore.load.
+"""
+
+import os
+import json
+import mmap
+import zlib
+import pickle
+import time
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+ARTIFACT_VERSION = 1
+# First line of an artifact manifest, which can not be the start of a pickle
+ARTIFACT_MAGIC = b'NUMERAUTO-ARTIFACT\n'
+# Buffers of at least this many bytes are stored out-of-band
+ARTIFACT_MMAP_MIN_SIZE = 1024 * 1024
+# Unreferenced blobs are only removed if they have not been written or reused
+# for this many seconds, so that blobs of artifacts being saved are kept
+ARTIFACT_GC_MIN_AGE = 3600
+
+
+def _get_tmp_filename(filename):
+    """ Get a temporary filename that is unique for the process and thread """
+
+    return '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+
+
+class ArtifactStore:
+    """
+    Store for pickled objects with compression, memory-mapping of large
+    buffers and deduplication.
+
+    Attributes:
+        directory: Base directory of the store, which contains the .blobs directory.
+        compression_level: zlib compression level (1 is fastest).
+        mmap_min_size: Minimum size in bytes of buffers that are stored
+                       out-of-band and memory-mapped when loaded.
+        use_mmap: Memory-map uncompressed out-of-band buffers when loading. If
+                  False, out-of-band buffers are compressed as well.
+    """
+
+    def __init__(self, directory, compression_level=1, mmap_min_size=ARTIFACT_MMAP_MIN_SIZE, use_mmap=True):
+        self.directory = Path(directory)
+        self.compression_level = compression_level
+        self.mmap_min_size = mmap_min_size
+        self.use_mmap = use_mmap
+
+    def get_blob_path(self, blob):
+        """
+        Get the filename of a blob.
+
+        Args:
+            blob: Name of the blob, as listed in an artifact manifest.
+        """
+
+        return self.directory / '.blobs' / blob[:2] / blob
+
+    def _write_blob(self, data, compress):
+        """
+        Write data to a blob, unless a blob with the same content exists.
+
+        Returns:
+            Name of the blob.
+        """
+
+        blob = hashlib.sha256(data).hexdigest() + ('.z' if compress else '.bin')
+        path = self.get_blob_path(blob)
+
+        if os.path.isfile(path):
+            # Mark the blob as recently used, so that it is not garbage collected
+            # before the manifest that refers to it has been written
+            os.utime(path)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_filename = _get_tmp_filename(path)
+            with open(tmp_filename, 'wb') as fp:
+                fp.write(zlib.compress(data, self.compression_level) if compress else data)
+            os.replace(tmp_filename, path)
+
+        return blob
+
+    def _read_blob(self, blob):
+        """ Read a blob, memory-mapping uncompressed blobs if enabled """
+
+        path = self.get_blob_path(blob)
+
+        if blob.endswith('.z'):
+            with open(path, 'rb') as fp:
+                return bytearray(zlib.decompress(fp.read()))
+
+        with open(path, 'rb') as fp:
+            if self.use_mmap and os.path.getsize(path) > 0:
+                # Copy-on-write, so that loaded arrays are writable
+                return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+            return bytearray(fp.read())
+
+    def save(self, obj, filename):
+        """
+        Atomically save an object to an artifact file.
+
+        Args:
+            obj: Object to save, which must be picklable.
+            filename: Filename of the artifact.
+
+        Returns:
+            Filename of the artifact.
+        """
+
+        buffers = []
+
+        def buffer_callback(buffer):
+            try:
+                data = buffer.raw()
+            except BufferError:
+                # Non-contiguous buffer, store in-band
+                return True
+            if data.nbytes < self.mmap_min_size:
+                return True
+            buffers.append(data)
+            return False
+
+        stream = pickle.dumps(obj, protocol=5, buffer_callback=buffer_callback)
+
+        manifest = {'version': ARTIFACT_VERSION,
+                    'pickle': self._write_blob(stream, compress=True),
+                    'buffers': [self._write_blob(data, compress=not self.use_mmap) for data in buffers]}
+
+        tmp_filename = _get_tmp_filename(filename)
+        with open(tmp_filename, 'wb') as fp:
+            fp.write(ARTIFACT_MAGIC)
+            fp.write(json.dumps(manifest).encode('utf-8'))
+        os.replace(tmp_filename, filename)
+
+        logger.debug('ArtifactStore: Saved %s (%d out-of-band buffers)', filename, len(buffers))
+        return filename
+
+    def read_manifest(self, filename):
+        """
+        Read the manifest of an artifact file.
+
+        Args:
+            filename: Filename of the artifact.
+
+        Returns:
+            Manifest dictionary, or None if the file is a plain pickle file.
+        """
+
+        with open(filename, 'rb') as fp:
+            if fp.read(len(ARTIFACT_MAGIC)) != ARTIFACT_MAGIC:
+                return None
+            return json.loads(fp.read().decode('utf-8'))
+
+    def get_blobs(self, filename):
+        """
+        Get the names of the blobs an artifact file refers to.
+
+        Args:
+            filename: Filename of the artifact.
+
+        Returns:
+            List of blob names (empty for plain pickle files).
+        """
+
+        manifest = self.read_manifest(filename)
+        if manifest is None:
+            return []
+        return [manifest['pickle']] + manifest['buffers']
+
+    def load(self, filename):
+        """
+        Load an object from an artifact file or a plain pickle file.
+
+        Args:
+            filename: Filename of the artifact.
+
+        Returns:
+            The loaded object.
+        """
+
+        manifest = self.read_manifest(filename)
+
+        if manifest is None:
+            with open(filename, 'rb') as fp:
+                return pickle.load(fp)
+
+        if manifest['version'] != ARTIFACT_VERSION:
+            raise ValueError('Unsupported artifact version {} in {}'.format(manifest['version'], filename))
+
+        stream = self._read_blob(manifest['pickle'])
+        buffers = [self._read_blob(blob) for blob in manifest['buffers']]
+
+        return pickle.loads(stream, buffers=buffers)
+
+    def collect_garbage(self, min_age=ARTIFACT_GC_MIN_AGE):
+        """
+        Remove blobs that are not referenced by any artifact file in the
+        directory of the store, and leftover temporary blob files.
+
+        Args:
+            min_age: Only remove blobs that have not been written or reused
+                     for this many seconds.
+
+        Returns:
+            Number of bytes removed.
+        """
+
+        blob_directory = self.directory / '.blobs'
+        if not os.path.isdir(blob_directory):
+            return 0
+
+        referenced = set()
+        for root, dirs, files in os.walk(self.directory):
+            if Path(root) == self.directory and '.blobs' in dirs:
+                dirs.remove('.blobs')
+            for name in files:
+                try:
+                    referenced.update(self.get_blobs(Path(root) / name))
+                except (OSError, ValueError):
+                    # Not an artifact file, or removed while scanning
+                    pass
+
+        removed = 0
+        threshold = time.time() - min_age
+        for path in blob_directory.glob('*/*'):
+            try:
+                stat = path.stat()
+                if path.name in referenced or stat.st_mtime > threshold:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += stat.st_size
+            logger.debug('ArtifactStore: Removed unreferenced blob %s', path)
+
+        if removed:
+            logger.info('ArtifactStore: Removed %d bytes of unreferenced blobs', removed)
+        return removed
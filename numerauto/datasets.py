@@ -0,0 +1,662 @@
+"""
+Dataset loading and caching for Numerauto
+
+Numerai datasets are distributed as large CSV files that are read by several
+parts of Numerauto every round. This module converts each CSV file once into a
+columnar cache of per-column .npy files, which can be memory-mapped so that
+later loads are nearly free.
+
+The cache for a dataset file <dir>/<name>.csv is stored in <dir>/.cache/<name>/
+and contains one .npy file per column plus a manifest.json file that lists
+the columns in their original order. Numeric columns are stored as float32 and
+string columns as fixed width unicode.
+
+Datasets can be loaded with a compact schema, in which features are stored as
+float32 (or uint8 codes), targets as float32, era and data_type as categoricals
+and id as a compact string type. This uses a fraction of the memory of the
+default pandas dtypes.
+
+The module also computes dataset fingerprints: order-independent digests of
+all rows, of the rows of each data_type and of the rows of each era. These are
+stored in <dir>/.cache/<name>.fingerprint.json and allow checking whether a
+dataset has changed without loading the previous dataset.
+
+Functions that read datasets in chunks or load them without cache also accept
+a ZipMember instead of a filename, to read a dataset file directly from the
+dataset archive without extracting it.
+"""
+
+import os
+import json
+import shutil
+import zipfile
+import logging
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+
+CACHE_VERSION = 2
+FINGERPRINT_VERSION = 1
+
+# Number of rows read at a time when computing fingerprints from a CSV file
+FINGERPRINT_CHUNKSIZE = 50000
+# Number of rows read at a time when converting a CSV file to the cache
+CONVERT_CHUNKSIZE = 10000
+
+# Columns that are always treated as strings
+STRING_COLUMNS = ('id', 'era', 'data_type')
+
+# Supported feature dtypes of the compact schema. With 'uint8', features are
+# stored as integer codes of Numerai's quantized feature values
+# (0, 0.25, 0.5, 0.75, 1 become 0, 1, 2, 3, 4).
+FEATURE_DTYPES = ('float64', 'float32', 'uint8')
+FEATURE_UINT8_SCALE = 4
+
+
+class ZipMember:
+    """
+    Reference to a dataset file inside a zip archive, which can be used in
+    place of a dataset filename to read the file without extracting it.
+    Nothing is cached or stored for a ZipMember.
+
+    Attributes:
+        zip_filename: Filename of the zip archive.
+        name: Filename of the dataset file inside the archive (directories
+              inside the archive are ignored).
+    """
+
+    def __init__(self, zip_filename, name):
+        self.zip_filename = zip_filename
+        self.name = name
+
+    def __str__(self):
+        return '{}:{}'.format(self.zip_filename, self.name)
+
+    def _find(self, z):
+        for member in z.namelist():
+            if os.path.basename(member) == self.name:
+                return member
+        return None
+
+    def exists(self):
+        """ Check whether the archive contains the dataset file """
+
+        if not os.path.isfile(self.zip_filename):
+            return False
+        with zipfile.ZipFile(self.zip_filename, 'r') as z:
+            return self._find(z) is not None
+
+    def open(self):
+        """ Open the dataset file for reading """
+
+        z = zipfile.ZipFile(self.zip_filename, 'r')
+        member = self._find(z)
+        if member is None:
+            z.close()
+            raise FileNotFoundError('{} not found in {}'.format(self.name, self.zip_filename))
+
+        # The opened member keeps the archive file open after closing z
+        fp = z.open(member, 'r')
+        z.close()
+        return fp
+
+
+def dataset_exists(filename):
+    """
+    Check whether a dataset file exists.
+
+    Args:
+        filename: Filename of the dataset CSV file, or a ZipMember.
+    """
+
+    if isinstance(filename, ZipMember):
+        return filename.exists()
+    return os.path.isfile(filename)
+
+
+def get_cache_path(filename):
+    """
+    Get the cache directory for a dataset file.
+
+    Args:
+        filename: Filename of the dataset CSV file.
+
+    Returns:
+        pathlib Path of the cache directory.
+    """
+
+    filename = Path(filename)
+    return filename.parent / '.cache' / filename.stem
+
+
+def get_fingerprint_path(filename):
+    """
+    Get the fingerprint filename for a dataset file.
+
+    Args:
+        filename: Filename of the dataset CSV file.
+
+    Returns:
+        pathlib Path of the fingerprint file.
+    """
+
+    filename = Path(filename)
+    return filename.parent / '.cache' / (filename.stem + '.fingerprint.json')
+
+
+def _is_source_unchanged(filename, info):
+    """
+    Check whether a dataset file still matches the size and modification time
+    recorded in a cache manifest or fingerprint. If the dataset file has been
+    removed, the recorded information is assumed to still be valid.
+    """
+
+    if not os.path.isfile(filename):
+        return True
+
+    stat = os.stat(filename)
+    return stat.st_size == info['source_size'] and stat.st_mtime_ns == info['source_mtime_ns']
+
+
+def _read_manifest(filename):
+    """
+    Read the cache manifest for a dataset file. Returns None if the cache does
+    not exist or is out of date with respect to the CSV file.
+    """
+
+    try:
+        with open(get_cache_path(filename) / 'manifest.json', 'r') as fp:
+            manifest = json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if manifest.get('version') != CACHE_VERSION:
+        return None
+
+    # A cache is only valid for the exact CSV file it was created from. If
+    # the CSV file has been removed the cache is still usable.
+    if not _is_source_unchanged(filename, manifest):
+        return None
+
+    return manifest
+
+
+def is_cached(filename):
+    """
+    Check whether a valid cache exists for a dataset file.
+
+    Args:
+        filename: Filename of the dataset CSV file.
+    """
+
+    return _read_manifest(filename) is not None
+
+
+def update_source_stat(filename, old_stat):
+    """
+    Update the size and modification time recorded in the cache manifest and
+    fingerprints of a dataset file, after the file has been replaced by a file
+    with the same content (e.g. a link to the dataset store). Only information
+    that matches the replaced file is updated.
+
+    Args:
+        filename: Filename of the dataset CSV file.
+        old_stat: os.stat result of the replaced file.
+    """
+
+    stat = os.stat(filename)
+    for info_filename in [get_cache_path(filename) / 'manifest.json', get_fingerprint_path(filename)]:
+        try:
+            with open(info_filename, 'r') as fp:
+                info = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            continue
+
+        if info.get('source_size') != old_stat.st_size or info.get('source_mtime_ns') != old_stat.st_mtime_ns:
+            continue
+
+        info['source_size'] = stat.st_size
+        info['source_mtime_ns'] = stat.st_mtime_ns
+        tmp_filename = '{}.tmp'.format(info_filename)
+        with open(tmp_filename, 'w') as fp:
+            json.dump(info, fp)
+        os.replace(tmp_filename, info_filename)
+
+
+def _to_cache_array(values, column):
+    """
+    Convert the values of a column to the dtype stored in the cache: strings
+    as fixed width unicode, which unlike Python objects can be memory-mapped,
+    and numbers as float32, which represents Numerai's quantized feature and
+    target values exactly.
+    """
+
+    if column in STRING_COLUMNS or not np.issubdtype(values.dtype, np.number):
+        return np.asarray(values.astype(str), dtype=str)
+    return values.to_numpy(dtype=np.float32)
+
+
+def convert_dataset(filename, chunksize=CONVERT_CHUNKSIZE):
+    """
+    Convert a dataset CSV file to the columnar cache format. Does nothing if
+    a valid cache already exists. The file is parsed in chunks, which are
+    converted to the cache dtypes right away, so that the full dataset is
+    never held in memory with the default pandas dtypes.
+
+    Args:
+        filename: Filename of the dataset CSV file.
+        chunksize: Number of rows to read at a time.
+
+    Returns:
+        pathlib Path of the cache directory.
+    """
+
+    cache_path = get_cache_path(filename)
+
+    if is_cached(filename):
+        logger.debug('convert_dataset: Cache for %s is up to date', filename)
+        return cache_path
+
+    logger.info('convert_dataset: Converting %s', filename)
+    stat = os.stat(filename)
+    columns, chunks = read_dataset_chunks(filename, chunksize)
+
+    # The data is read anyway, so compute its fingerprints as well
+    fingerprinter = _Fingerprinter(columns) if _read_fingerprints(filename) is None else None
+
+    values = {column: [] for column in columns}
+    rows = 0
+    for chunk in chunks:
+        if fingerprinter is not None:
+            fingerprinter.update(chunk)
+        for column in columns:
+            values[column].append(_to_cache_array(chunk[column], column))
+        rows += len(chunk)
+
+    # Write to a temporary directory first, so that an interrupted conversion
+    # never leaves a partial cache behind.
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+
+    manifest_columns = []
+    for i, column in enumerate(columns):
+        chunk_values = values.pop(column)
+        if chunk_values:
+            column_values = np.concatenate(chunk_values)
+        else:
+            column_values = np.empty(0, dtype=str if column in STRING_COLUMNS else np.float32)
+        del chunk_values
+
+        column_filename = '{}.npy'.format(i)
+        np.save(tmp_path / column_filename, column_values, allow_pickle=False)
+        manifest_columns.append({'name': column, 'filename': column_filename})
+        del column_values
+
+    manifest = {'version': CACHE_VERSION,
+                'source_size': stat.st_size,
+                'source_mtime_ns': stat.st_mtime_ns,
+                'rows': rows,
+                'columns': manifest_columns}
+    with open(tmp_path / 'manifest.json', 'w') as fp:
+        json.dump(manifest, fp)
+
+    if cache_path.exists():
+        shutil.rmtree(cache_path)
+    os.replace(tmp_path, cache_path)
+
+    if fingerprinter is not None:
+        _write_fingerprints(filename, fingerprinter.result(stat))
+
+    return cache_path
+
+
+def _get_id_dtype():
+    """ Get the most compact string dtype available for the id column """
+
+    if importlib.util.find_spec('pyarrow') is None:
+        return object
+    try:
+        return pd.StringDtype('pyarrow')
+    except TypeError:
+        # pandas versions without pyarrow string support
+        return object
+
+
+def get_dataset_schema(columns, feature_dtype='float32'):
+    """
+    Get the compact schema for a Numerai dataset.
+
+    Args:
+        columns: List of column names in the dataset.
+        feature_dtype: dtype for the feature columns (see FEATURE_DTYPES).
+
+    Returns:
+        Dictionary mapping column name to dtype.
+    """
+
+    if feature_dtype not in FEATURE_DTYPES:
+        raise ValueError('Unsupported feature dtype: {}'.format(feature_dtype))
+
+    schema = {}
+    for column in columns:
+        if column == 'id':
+            schema[column] = _get_id_dtype()
+        elif column in STRING_COLUMNS:
+            schema[column] = 'category'
+        elif column.startswith('feature'):
+            schema[column] = np.dtype(feature_dtype)
+        else:
+            # Targets may contain NaN, so they can not be stored as codes
+            schema[column] = np.dtype('float32')
+
+    return schema
+
+
+def _apply_schema(df, schema):
+    """ Convert the columns of a DataFrame to the dtypes in a schema """
+
+    for column, dtype in schema.items():
+        values = df[column]
+        if dtype == np.uint8:
+            codes = np.rint(values.to_numpy() * FEATURE_UINT8_SCALE)
+            if np.abs(codes / FEATURE_UINT8_SCALE - values.to_numpy()).max(initial=0) > 1e-6:
+                raise ValueError('Column {} can not be stored as uint8 codes, '
+                                 'values are not quantized'.format(column))
+            df[column] = codes.astype(np.uint8)
+        elif values.dtype != dtype:
+            df[column] = values.astype(dtype)
+
+    return df
+
+
+def load_dataset(filename, columns=None, mmap=True, feature_dtype=None):
+    """
+    Load a Numerai dataset. If a cache exists for the dataset, the columns are
+    loaded from the cache (memory-mapped by default). Otherwise the CSV file is
+    parsed.
+
+    Args:
+        filename: Filename of the dataset CSV file.
+        columns: List of columns to load (default: None, i.e. all columns)
+        mmap: Memory-map the cached columns instead of reading them into memory.
+        feature_dtype: Load the dataset with the compact schema using this
+                       feature dtype (see get_dataset_schema). The default
+                       None loads the data with full precision.
+
+    Returns:
+        pandas DataFrame containing the dataset.
+    """
+
+    manifest = _read_manifest(filename) if not isinstance(filename, ZipMember) else None
+
+    if manifest is None:
+        logger.debug('load_dataset: Reading %s', filename)
+        dtype = None
+        if feature_dtype is not None:
+            if columns is None:
+                columns = read_dataset_columns(filename)
+            schema = get_dataset_schema(columns, feature_dtype)
+            # uint8 codes are computed after parsing
+            dtype = {c: np.float32 if d == np.uint8 else d for c, d in schema.items()}
+
+        if isinstance(filename, ZipMember):
+            with filename.open() as fp:
+                df = pd.read_csv(fp, header=0, usecols=columns, dtype=dtype)
+        else:
+            df = pd.read_csv(filename, header=0, usecols=columns, dtype=dtype)
+        if columns is not None:
+            df = df[list(columns)]
+        if feature_dtype is not None:
+            df = _apply_schema(df, schema)
+        return df
+
+    logger.debug('load_dataset: Loading %s from cache', filename)
+    cache_path = get_cache_path(filename)
+    column_files = {c['name']: c['filename'] for c in manifest['columns']}
+
+    if columns is None:
+        columns = [c['name'] for c in manifest['columns']]
+
+    missing = [c for c in columns if c not in column_files]
+    if missing:
+        raise KeyError('Columns not found in dataset {}: {}'.format(filename, missing))
+
+    data = {c: np.load(cache_path / column_files[c], mmap_mode='r' if mmap else None,
+                       allow_pickle=False)
+            for c in columns}
+    df = pd.DataFrame(data, columns=columns, copy=False)
+
+    if feature_dtype is not None:
+        df = _apply_schema(df, get_dataset_schema(columns, feature_dtype))
+
+    return df
+
+
+def read_dataset_columns(filename):
+    """
+    Read the column names of a dataset CSV file.
+
+    Args:
+        filename: Filename of the dataset CSV file, or a ZipMember.
+
+    Returns:
+        List of column names.
+    """
+
+    if isinstance(filename, ZipMember):
+        with filename.open() as fp:
+            return list(pd.read_csv(fp, header=0, nrows=0).columns)
+
+    return list(pd.read_csv(filename, header=0, nrows=0).columns)
+
+
+def _iterate_chunks(filename, dtype, chunksize):
+    """ Generator over the chunks of a dataset file or ZipMember """
+
+    if isinstance(filename, ZipMember):
+        with filename.open() as fp:
+            for chunk in pd.read_csv(fp, header=0, dtype=dtype, chunksize=chunksize):
+                yield chunk
+    else:
+        for chunk in pd.read_csv(filename, header=0, dtype=dtype, chunksize=chunksize):
+            yield chunk
+
+
+def read_dataset_chunks(filename, chunksize):
+    """
+    Read a dataset CSV file in chunks.
+
+    Args:
+        filename: Filename of the dataset CSV file, or a ZipMember.
+        chunksize: Number of rows per chunk.
+
+    Returns:
+        Tuple of the list of column names and an iterator over pandas
+        DataFrame chunks.
+    """
+
+    columns = read_dataset_columns(filename)
+    dtype = {c: str for c in columns if c in STRING_COLUMNS}
+
+    return columns, _iterate_chunks(filename, dtype, chunksize)
+
+
+def hash_rows(df, columns=None):
+    """
+    Compute a 64-bit hash of every row of a dataset. The hash does not depend
+    on the dtypes pandas inferred when parsing the data.
+
+    Args:
+        df: pandas DataFrame containing (a chunk of) a dataset.
+        columns: Columns to include in the hash (default: None, i.e. all columns)
+
+    Returns:
+        numpy uint64 array with one hash per row.
+    """
+
+    if columns is None:
+        columns = list(df.columns)
+
+    hashes = np.zeros(len(df), dtype=np.uint64)
+
+    for column in columns:
+        values = df[column].to_numpy()
+        if column in STRING_COLUMNS or not np.issubdtype(values.dtype, np.number):
+            values = np.asarray(values, dtype=str).astype(object)
+        else:
+            # Parse dtypes may differ per chunk (e.g. int vs float)
+            values = values.astype(np.float64)
+
+        hashes = (hashes * np.uint64(1000003)) ^ pd.util.hash_array(values, categorize=False)
+
+    return hashes
+
+
+class _Fingerprinter:
+    """
+    Accumulates order-independent row digests over chunks of a dataset.
+
+    Every row is hashed over all of its columns. The digest of a group of rows
+    consists of the number of rows and the sum and xor of their row hashes,
+    which does not depend on the order of the rows.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.groups = {'all': {}, 'data_type': {}, 'era': {}}
+
+    def _accumulate(self, groups, keys, hashes):
+        codes, uniques = pd.factorize(keys)
+        order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[order]
+        sorted_hashes = hashes[order]
+
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        counts = np.diff(np.r_[starts, len(sorted_codes)])
+        sums = np.add.reduceat(sorted_hashes, starts)
+        xors = np.bitwise_xor.reduceat(sorted_hashes, starts)
+
+        for start, count, hash_sum, hash_xor in zip(starts, counts, sums, xors):
+            key = str(uniques[sorted_codes[start]])
+            digest = groups.setdefault(key, [0, 0, 0])
+            digest[0] += int(count)
+            digest[1] = (digest[1] + int(hash_sum)) % 2**64
+            digest[2] ^= int(hash_xor)
+
+    def update(self, df):
+        """ Add a chunk of rows to the fingerprints """
+
+        if len(df) == 0:
+            return
+
+        hashes = hash_rows(df, self.columns)
+        self._accumulate(self.groups['all'], np.zeros(len(df), dtype=np.int64), hashes)
+        for group in ('data_type', 'era'):
+            if group in df.columns:
+                self._accumulate(self.groups[group],
+                                 np.asarray(df[group], dtype=str).astype(object), hashes)
+
+    def result(self, stat):
+        """ Get the fingerprint dictionary """
+
+        to_digest = lambda x: '{:d}-{:016x}-{:016x}'.format(*x)
+
+        return {'version': FINGERPRINT_VERSION,
+                'source_size': stat.st_size if stat is not None else None,
+                'source_mtime_ns': stat.st_mtime_ns if stat is not None else None,
+                'columns': self.columns,
+                'all': to_digest(self.groups['all'].get('0', [0, 0, 0])),
+                'data_type': {k: to_digest(v) for k, v in self.groups['data_type'].items()},
+                'era': {k: to_digest(v) for k, v in self.groups['era'].items()}}
+
+
+def _read_fingerprints(filename):
+    """
+    Read the stored fingerprints of a dataset file. Returns None if they do not
+    exist or are out of date with respect to the CSV file.
+    """
+
+    try:
+        with open(get_fingerprint_path(filename), 'r') as fp:
+            fingerprints = json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if fingerprints.get('version') != FINGERPRINT_VERSION:
+        return None
+
+    if not _is_source_unchanged(filename, fingerprints):
+        return None
+
+    return fingerprints
+
+
+def _write_fingerprints(filename, fingerprints):
+    """ Atomically write the fingerprints of a dataset file """
+
+    fingerprint_path = get_fingerprint_path(filename)
+    fingerprint_path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = fingerprint_path.with_name(fingerprint_path.name + '.tmp')
+    with open(tmp_path, 'w') as fp:
+        json.dump(fingerprints, fp)
+    os.replace(tmp_path, fingerprint_path)
+
+
+def compute_fingerprints(filename, chunksize=FINGERPRINT_CHUNKSIZE):
+    """
+    Compute the fingerprints of a dataset CSV file in a single chunked pass,
+    using a constant amount of memory.
+
+    Args:
+        filename: Filename of the dataset CSV file, or a ZipMember.
+        chunksize: Number of rows to read at a time.
+
+    Returns:
+        Dictionary containing the digest of all rows ('all'), and dictionaries
+        with the digests per data type ('data_type') and per era ('era').
+    """
+
+    logger.info('compute_fingerprints: Computing fingerprints of %s', filename)
+    stat = os.stat(filename) if not isinstance(filename, ZipMember) else None
+
+    columns, chunks = read_dataset_chunks(filename, chunksize)
+
+    fingerprinter = _Fingerprinter(columns)
+    for chunk in chunks:
+        fingerprinter.update(chunk)
+
+    return fingerprinter.result(stat)
+
+
+def get_fingerprints(filename):
+    """
+    Get the fingerprints of a dataset file. Stored fingerprints are used if
+    available, otherwise they are computed and stored next to the dataset.
+
+    Args:
+        filename: Filename of the dataset CSV file, or a ZipMember (which
+                  are computed every time).
+
+    Returns:
+        Fingerprint dictionary (see compute_fingerprints).
+    """
+
+    if isinstance(filename, ZipMember):
+        return compute_fingerprints(filename)
+
+    fingerprints = _read_fingerprints(filename)
+
+    if fingerprints is None:
+        fingerprints = compute_fingerprints(filename)
+        _write_fingerprints(filename, fingerprints)
+
+    return fingerprints
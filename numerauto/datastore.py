@@ -0,0 +1,202 @@
+"""
+Dataset store for Numerauto
+
+Most files of a Numerai dataset, in particular the training data and its
+columnar cache, are identical in many consecutive rounds. The dataset store
+keeps each distinct file once in the .store directory of the data directory,
+named by the SHA256 hash of its content. The files in the dataset directories
+of the rounds are hardlinks to the stored files, or symlinks if hardlinks are
+not supported, so the dataset directories keep their usual layout.
+
+Stored files that are no longer linked from any dataset directory are removed
+by collect_garbage. The retention policy in Numerauto removes the datasets of
+old rounds when the data directory exceeds its disk budget.
+"""
+
+import os
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+
+from . import datasets
+
+
+logger = logging.getLogger(__name__)
+
+
+# Only files of at least this many bytes are moved to the store
+DATASET_STORE_MIN_SIZE = 1024 * 1024
+DATASET_STORE_CHUNKSIZE = 1024 * 1024
+
+
+def _hash_file(filename):
+    """ Compute the SHA256 hash of a file """
+
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(DATASET_STORE_CHUNKSIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_disk_usage(directory):
+    """
+    Get the disk usage of all files in a directory. Files with multiple
+    hardlinks are counted once, symlinks are not counted.
+
+    Args:
+        directory: Directory to scan.
+
+    Returns:
+        Total size in bytes.
+    """
+
+    inodes = set()
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            filename = os.path.join(root, name)
+            stat = os.lstat(filename)
+            if os.path.islink(filename) or (stat.st_dev, stat.st_ino) in inodes:
+                continue
+            inodes.add((stat.st_dev, stat.st_ino))
+            total += stat.st_size
+    return total
+
+
+class DatasetStore:
+    """
+    Content-addressed store of dataset files.
+
+    Attributes:
+        data_directory: Data directory that contains the dataset directories.
+        directory: Directory of the stored files (<data_directory>/.store).
+        min_size: Minimum size in bytes of files that are moved to the store.
+    """
+
+    def __init__(self, data_directory, min_size=DATASET_STORE_MIN_SIZE):
+        self.data_directory = Path(data_directory)
+        self.directory = self.data_directory / '.store'
+        self.min_size = min_size
+
+    def get_object_path(self, digest):
+        """
+        Get the filename of a stored file.
+
+        Args:
+            digest: SHA256 hash of the content of the file.
+        """
+
+        return self.directory / digest[:2] / digest
+
+    def _is_stored(self, filename):
+        """ Check whether a file is already linked to the store """
+
+        if os.path.islink(filename):
+            return Path(os.readlink(filename)).parent.parent == self.directory.absolute()
+        # Files in the dataset directories are never hardlinked otherwise
+        return os.stat(filename).st_nlink > 1
+
+    def _link(self, object_path, filename):
+        """
+        Atomically replace a file with a hardlink to a stored file, or a
+        symlink if hardlinks are not supported.
+        """
+
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        try:
+            os.link(object_path, tmp_filename)
+        except OSError:
+            os.symlink(object_path.absolute(), tmp_filename)
+        os.replace(tmp_filename, filename)
+
+    def add_file(self, filename):
+        """
+        Move a file to the store, replacing it with a link to the stored file.
+        If the store already contains a file with the same content, the file
+        is replaced with a link to the existing stored file.
+
+        Args:
+            filename: Filename of the file.
+
+        Returns:
+            Number of bytes saved by linking to an existing stored file.
+        """
+
+        stat = os.stat(filename)
+        object_path = self.get_object_path(_hash_file(filename))
+
+        if os.path.isfile(object_path):
+            self._link(object_path, filename)
+            # The linked file has the modification time of the stored file,
+            # update the cache and fingerprints of a dataset file accordingly
+            datasets.update_source_stat(filename, stat)
+            logger.debug('DatasetStore: Linked %s to %s', filename, object_path)
+            return stat.st_size
+
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(filename, object_path)
+        except OSError:
+            # Hardlinks are not supported, store a copy and use a symlink
+            tmp_filename = '{}.{}.tmp'.format(object_path, os.getpid())
+            shutil.copy2(filename, tmp_filename)
+            os.replace(tmp_filename, object_path)
+            self._link(object_path, filename)
+        logger.debug('DatasetStore: Stored %s as %s', filename, object_path)
+        return 0
+
+    def add_directory(self, path):
+        """
+        Move all files of a dataset directory (including its cache) to the
+        store, except files smaller than min_size.
+
+        Args:
+            path: Dataset directory.
+
+        Returns:
+            Number of bytes saved by linking to existing stored files.
+        """
+
+        saved = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                filename = Path(root) / name
+                if os.path.getsize(filename) >= self.min_size and not self._is_stored(filename):
+                    saved += self.add_file(filename)
+
+        if saved > 0:
+            logger.info('DatasetStore: Deduplicated %.1f MB of %s', saved / 2**20, path)
+        return saved
+
+    def collect_garbage(self):
+        """
+        Remove stored files that are not linked from the data directory.
+
+        Returns:
+            Number of bytes freed.
+        """
+
+        if not os.path.isdir(self.directory):
+            return 0
+
+        # Stored files can be referenced by symlinks instead of hardlinks
+        symlinked = set()
+        for root, dirs, files in os.walk(self.data_directory):
+            if Path(root) == self.data_directory and '.store' in dirs:
+                dirs.remove('.store')
+            for name in files:
+                filename = os.path.join(root, name)
+                if os.path.islink(filename):
+                    symlinked.add(os.path.realpath(filename))
+
+        freed = 0
+        for object_path in self.directory.glob('*/*'):
+            stat = os.stat(object_path)
+            if stat.st_nlink <= 1 and os.path.realpath(object_path) not in symlinked:
+                logger.debug('DatasetStore: Removing %s', object_path)
+                os.remove(object_path)
+                freed += stat.st_size
+
+        return freed
@@ -0,0 +1,413 @@
+"""
+Dataset download for Numerauto
+
+Downloads dataset archives with support for conditional re-fetching and
+resuming interrupted downloads. For every downloaded archive <name>.zip, the
+response headers and checksums are stored in <name>.zip.download.json. These
+are used to detect that the archive offered by the server is the same as a
+previously downloaded archive without downloading it again, and to resume an
+interrupted download from <name>.zip.part with HTTP range requests. Archives
+can be downloaded over multiple connections in concurrent byte ranges.
+"""
+
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+import concurrent.futures
+
+from requests.exceptions import RequestException
+
+
+logger = logging.getLogger(__name__)
+
+
+DOWNLOAD_CHUNKSIZE = 64 * 1024
+# Minimum size of a byte range in a parallel download
+DOWNLOAD_MIN_RANGE_SIZE = 1024 * 1024
+# Number of bytes after which the progress of a parallel download is saved
+DOWNLOAD_PROGRESS_INTERVAL = 8 * 1024 * 1024
+
+
+class DownloadError(RequestException):
+    """ Error that is raised if a downloaded file fails verification. """
+    pass
+
+
+def get_info_filename(filename):
+    """
+    Get the filename of the download information file for a downloaded file.
+
+    Args:
+        filename: Filename of the downloaded file.
+    """
+
+    return str(filename) + '.download.json'
+
+
+def read_download_info(filename):
+    """
+    Read the download information of a downloaded file.
+
+    Args:
+        filename: Filename of the downloaded file.
+
+    Returns:
+        Dictionary with the download information, or None if not available.
+    """
+
+    try:
+        with open(get_info_filename(filename), 'r') as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_download_info(filename, info):
+    """
+    Atomically write the download information of a downloaded file.
+
+    Args:
+        filename: Filename of the downloaded file.
+        info: Dictionary with the download information.
+    """
+
+    info_filename = get_info_filename(filename)
+    with open(info_filename + '.tmp', 'w') as fp:
+        json.dump(info, fp)
+    os.replace(info_filename + '.tmp', info_filename)
+
+
+def _get_md5_etag(etag):
+    """ Get the MD5 hash from an ETag, if the ETag is a plain MD5 hash """
+
+    if etag is None:
+        return None
+
+    etag = etag.strip('"').lower()
+    return etag if re.fullmatch('[0-9a-f]{32}', etag) else None
+
+
+def compute_file_info(filename):
+    """
+    Compute the size and checksums of a file that was not downloaded using
+    this module, such that it can be compared to a remote file.
+
+    Args:
+        filename: Filename of the file.
+
+    Returns:
+        Dictionary with download information of the file.
+    """
+
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(DOWNLOAD_CHUNKSIZE), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+
+    return {'etag': None,
+            'last_modified': None,
+            'content_length': os.path.getsize(filename),
+            'md5': md5.hexdigest(),
+            'sha256': sha256.hexdigest(),
+            'complete': True}
+
+
+def get_remote_info(session, url, timeout=None):
+    """
+    Get the ETag, modification time and size of a remote file without
+    downloading it. A GET request for the first byte is used instead of a
+    HEAD request, as presigned URLs are only valid for GET requests.
+
+    Args:
+        session: requests Session to use.
+        url: URL of the file.
+        timeout: Request timeout in seconds.
+
+    Returns:
+        Dictionary with the remote file information.
+    """
+
+    with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+
+        content_length = None
+        if r.status_code == 206 and 'Content-Range' in r.headers:
+            total = r.headers['Content-Range'].rsplit('/', 1)[-1]
+            content_length = int(total) if total.isdigit() else None
+        elif 'Content-Length' in r.headers:
+            content_length = int(r.headers['Content-Length'])
+
+        return {'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified'),
+                'content_length': content_length,
+                'accept_ranges': r.status_code == 206}
+
+
+def is_same_file(remote_info, info):
+    """
+    Check whether a remote file is the same as a previously downloaded file.
+
+    Args:
+        remote_info: Remote file information (see get_remote_info).
+        info: Download information of the previously downloaded file.
+
+    Returns:
+        True if the files are known to be the same, False otherwise.
+    """
+
+    if info is None or not info.get('complete'):
+        return False
+
+    if remote_info['etag'] is not None and info.get('etag') is not None:
+        return remote_info['etag'] == info['etag']
+
+    remote_md5 = _get_md5_etag(remote_info['etag'])
+    if remote_md5 is not None and info.get('md5') is not None:
+        return remote_md5 == info['md5']
+
+    if remote_info['last_modified'] is not None and remote_info['content_length'] is not None:
+        return remote_info['last_modified'] == info.get('last_modified') and \
+               remote_info['content_length'] == info.get('content_length')
+
+    return False
+
+
+def _split_ranges(size, connections):
+    """
+    Split a file into byte ranges for a parallel download. Each range is a
+    list [start, end, downloaded], where end is exclusive and downloaded is
+    the number of bytes of the range that have been written.
+    """
+
+    n = max(1, min(connections, size // DOWNLOAD_MIN_RANGE_SIZE))
+    bounds = [size * i // n for i in range(n + 1)]
+    return [[bounds[i], bounds[i + 1], 0] for i in range(n)]
+
+
+def _download_range(session, url, part_filename, byte_range, etag, timeout, stop, save_progress):
+    """
+    Download the remaining part of a byte range into its position in a
+    preallocated file. The downloaded count of the range is only updated for
+    data that has been flushed to the file, and save_progress is called
+    regularly and when the download of the range ends or fails. Returns early without error when the stop event
+    is set.
+    """
+
+    start, end, downloaded = byte_range
+    if downloaded >= end - start:
+        return
+
+    headers = {'Range': 'bytes={}-{}'.format(start + downloaded, end - 1)}
+    if etag is not None:
+        headers['If-Range'] = etag
+
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+
+        # A full response means that the file has changed or the server
+        # ignores the range
+        if r.status_code != 206 or \
+                not r.headers.get('Content-Range', '').startswith('bytes {}-'.format(start + downloaded)):
+            raise DownloadError('Server did not return the requested range of {}'.format(url))
+
+        with open(part_filename, 'r+b') as fp:
+            fp.seek(start + downloaded)
+            written = 0
+            try:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNKSIZE):
+                    if stop.is_set():
+                        break
+                    chunk = chunk[:end - start - byte_range[2] - written]
+                    fp.write(chunk)
+                    written += len(chunk)
+                    if written >= DOWNLOAD_PROGRESS_INTERVAL:
+                        fp.flush()
+                        byte_range[2] += written
+                        written = 0
+                        save_progress()
+            finally:
+                # Also count and save the data written before the download
+                # was stopped or failed
+                fp.flush()
+                byte_range[2] += written
+                save_progress()
+
+    if not stop.is_set() and byte_range[2] != end - start:
+        raise DownloadError('Incomplete range {}-{} of {}'.format(start, end - 1, url))
+
+
+def _download_parallel(session, url, part_filename, remote_info, connections, timeout):
+    """
+    Download a file in multiple byte ranges concurrently into a preallocated
+    part file. Progress is stored per range, so that an interrupted download
+    can be resumed.
+    """
+
+    size = remote_info['content_length']
+    part_info = read_download_info(part_filename)
+
+    if os.path.isfile(part_filename) and part_info is not None and part_info.get('ranges') and \
+            remote_info['etag'] is not None and part_info.get('etag') == remote_info['etag'] and \
+            os.path.getsize(part_filename) == size:
+        ranges = part_info['ranges']
+        logger.info('download_file: Resuming download of %s at %d bytes',
+                    part_filename, sum(r[2] for r in ranges))
+    else:
+        ranges = _split_ranges(size, connections)
+        logger.info('download_file: Downloading %s in %d ranges', part_filename, len(ranges))
+        with open(part_filename, 'wb') as fp:
+            fp.truncate(size)
+
+    lock = threading.Lock()
+
+    def save_progress():
+        with lock:
+            write_download_info(part_filename, {**remote_info, 'complete': False,
+                                                'ranges': [list(x) for x in ranges]})
+
+    save_progress()
+
+    # On an error or interrupt, the remaining ranges are stopped at their
+    # next chunk, and the progress so far is saved
+    stop = threading.Event()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges))
+    futures = []
+    try:
+        futures = [executor.submit(_download_range, session, url, part_filename, byte_range,
+                                   remote_info['etag'], timeout, stop, save_progress)
+                   for byte_range in ranges]
+        done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+        for future in done:
+            future.result()
+    except BaseException:
+        stop.set()
+        for future in futures:
+            future.cancel()
+        # Wait for the running ranges to stop, so that they do not write to
+        # the part file after returning (e.g. while a retry resumes it)
+        concurrent.futures.wait(futures, timeout=timeout)
+        raise
+    finally:
+        executor.shutdown(wait=False)
+        save_progress()
+
+
+def _download_stream(session, url, part_filename, remote_info, timeout):
+    """
+    Download a file in a single stream, resuming an earlier download of the
+    same file if possible. Returns the MD5 and SHA256 hash objects of the
+    downloaded data.
+    """
+
+    part_info = read_download_info(part_filename)
+
+    headers = {}
+    offset = 0
+    if os.path.isfile(part_filename) and part_info is not None and not part_info.get('ranges') and \
+            remote_info['accept_ranges'] and remote_info['etag'] is not None and \
+            part_info.get('etag') == remote_info['etag'] and \
+            os.path.getsize(part_filename) < (remote_info['content_length'] or 0):
+        offset = os.path.getsize(part_filename)
+        headers = {'Range': 'bytes={}-'.format(offset), 'If-Range': remote_info['etag']}
+        logger.info('download_file: Resuming download of %s at %d bytes', part_filename, offset)
+    else:
+        logger.info('download_file: Downloading %s', part_filename)
+
+    write_download_info(part_filename, {**remote_info, 'complete': False})
+
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+
+        if r.status_code == 206:
+            # Hash the data that was downloaded earlier
+            with open(part_filename, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(DOWNLOAD_CHUNKSIZE), b''):
+                    md5.update(chunk)
+                    sha256.update(chunk)
+            mode = 'ab'
+        else:
+            mode = 'wb'
+
+        with open(part_filename, mode) as fp:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNKSIZE):
+                fp.write(chunk)
+                md5.update(chunk)
+                sha256.update(chunk)
+
+    return md5, sha256
+
+
+def download_file(session, url, filename, remote_info=None, timeout=None, connections=1):
+    """
+    Download a file. If the server supports range requests and multiple
+    connections are requested, the file is downloaded in concurrent byte
+    ranges, otherwise it is downloaded in a single stream. If an earlier
+    download of the same remote file was interrupted, the download is
+    resumed. The downloaded file is verified against the size and (if
+    available) the MD5 ETag reported by the server.
+
+    Args:
+        session: requests Session to use.
+        url: URL of the file.
+        filename: Destination filename.
+        remote_info: Remote file information (default: None, i.e. requested
+                     using get_remote_info)
+        timeout: Request timeout in seconds.
+        connections: Maximum number of concurrent connections (default: 1)
+
+    Returns:
+        Dictionary with the download information of the file.
+    """
+
+    if remote_info is None:
+        remote_info = get_remote_info(session, url, timeout=timeout)
+
+    part_filename = str(filename) + '.part'
+
+    if connections > 1 and remote_info['accept_ranges'] and \
+            (remote_info['content_length'] or 0) >= 2 * DOWNLOAD_MIN_RANGE_SIZE:
+        _download_parallel(session, url, part_filename, remote_info, connections, timeout)
+
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        with open(part_filename, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(DOWNLOAD_CHUNKSIZE), b''):
+                md5.update(chunk)
+                sha256.update(chunk)
+    else:
+        md5, sha256 = _download_stream(session, url, part_filename, remote_info, timeout)
+
+    size = os.path.getsize(part_filename)
+    if remote_info['content_length'] is not None and size != remote_info['content_length']:
+        # An incomplete download can be resumed later, a too large one can not
+        if size > remote_info['content_length']:
+            os.remove(part_filename)
+        raise DownloadError('Downloaded file {} has size {}, expected {}'.format(
+            filename, size, remote_info['content_length']))
+
+    expected_md5 = _get_md5_etag(remote_info['etag'])
+    if expected_md5 is not None and md5.hexdigest() != expected_md5:
+        os.remove(part_filename)
+        os.remove(get_info_filename(part_filename))
+        raise DownloadError('Downloaded file {} failed MD5 verification'.format(filename))
+
+    info = {'etag': remote_info['etag'],
+            'last_modified': remote_info['last_modified'],
+            'content_length': size,
+            'md5': md5.hexdigest(),
+            'sha256': sha256.hexdigest(),
+            'complete': True}
+
+    os.replace(part_filename, filename)
+    write_download_info(filename, info)
+    os.remove(get_info_filename(part_filename))
+
+    return info
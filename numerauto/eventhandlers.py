@@ -4,17 +4,19 @@ Numerauto event handlers module
 
 import os
 from pathlib import Path
-import pickle
 import logging
 import collections
 import smtplib
+import tempfile
+import concurrent.futures
 
+import numpy as np
 import pandas as pd
-from scipy.stats import spearmanr
 
 from numerapi.utils import ensure_directory_exists
-from .robust_numerapi import RobustNumerAPI, NumerAPIError
-from .utils import wait_for_retry
+from .robust_numerapi import NumerAPIError
+from .utils import wait_for_retry, spearman_by_era
+from .artifacts import ArtifactStore
 
 
 logger = logging.getLogger(__name__)
@@ -31,14 +33,22 @@ class EventHandler:
     Attributes:
         name: Name of the event handler
         numerauto: Numerauto instance this handler is added to (None if not added)
+        dependencies: Names of the event handlers whose events must be
+                      processed before the events of this handler
+        dataset_files: Names of the data files of the dataset this handler
+                       reads, which are extracted from the dataset archive.
+                       None if the handler may read any file.
     """
 
-    def __init__(self, name):
+    dataset_files = None
+
+    def __init__(self, name, dependencies=None):
         """
         Creates a new EventHandler instance.
 
         Args:
             name: Event handler name.
+            dependencies: List of names of event handlers this handler depends on.
         """
 
         if name == '':
@@ -46,6 +56,7 @@ class EventHandler:
 
         self.name = name
         self.numerauto = None
+        self.dependencies = list(dependencies) if dependencies is not None else []
 
     def on_start(self):
         """ Triggered when the Numerauto daemon starts """
@@ -82,14 +93,37 @@ class SKLearnModelTrainer(EventHandler):
     able to be written to file using pickle.
 
     Each time the model is trained, it is saved to the
-    numerauto.config['model_directory'] directory (defaults to ./models):
+    numerauto.config['model_directory'] directory (defaults to ./models)
+    using a numerauto.artifacts.ArtifactStore:
         ./models/tournament_<name>/round_<num>/<name>.p
-    Each time the model is applied, predictions are written to the
-    numerauto.config['prediction_directory'] directory (defaults to ./predictions):
+    The model is written in a background task and kept in memory, so it is
+    only loaded from file after a restart. If the
+    numerauto.config['model_cache'] entry is False, models are removed from
+    memory at the end of each round.
+
+    With incremental=True, a model that implements 'partial_fit' is updated
+    with the eras that were added to the training data since the last round
+    trained, instead of being trained from scratch. Ensembles with
+    'warm_start' and 'n_estimators' parameters (e.g. gradient boosting) are
+    updated by fitting warm_start_estimators additional estimators on the
+    added eras, if warm_start_estimators is set. Other models are always
+    trained from scratch. A full retrain is done if eras were changed or
+    removed, and at least every numerauto.config['full_retrain_interval']
+    training rounds (defaults to 4, 0 disables forced retraining). If no eras
+    were added, e.g. if only the validation data changed, the model of the
+    last round trained is kept, which does not count as a training round.
+
+    Each time the model is applied, predictions are published in the
+    prediction registry of the round and written in a background task to the
+    numerauto.config['prediction_directory'] directory (defaults to ./predictions),
+    unless numerauto.config['write_prediction_files'] is False:
         ./predictions/tournament_<name>/round_<num>/<name>.csv
     """
 
-    def __init__(self, name, model_factory, tournament_id=None):
+    dataset_files = ['numerai_training_data.csv', 'numerai_tournament_data.csv']
+
+    def __init__(self, name, model_factory, tournament_id=None, dependencies=None, incremental=False,
+                 warm_start_estimators=None):
         """
         Creates a new SKLearnModelTrainer instance.
 
@@ -98,11 +132,23 @@ class SKLearnModelTrainer(EventHandler):
             model_factory: Function that creates a new model instance.
                            The function must take no arguments.
             tournament_id: ID of the tournament to upload predictions to. The default None will copy the tournament id of the Numerauto instance
+            dependencies: List of names of event handlers this handler depends on.
+            incremental: Update the model of the last round trained with new
+                         eras if possible, instead of training from scratch.
+            warm_start_estimators: Number of estimators added to a warm_start
+                                   ensemble in an incremental update. The
+                                   default None disables warm_start updates.
         """
 
-        super().__init__(name)
+        super().__init__(name, dependencies)
         self.model_factory = model_factory
         self.tournament_id = tournament_id
+        self.incremental = incremental
+        self.warm_start_estimators = warm_start_estimators
+
+        # Models in memory by model name, as (model filename, model) tuples
+        self._models = {}
+        self.artifacts = None
 
     def on_start(self):
         if self.tournament_id is None:
@@ -113,36 +159,152 @@ class SKLearnModelTrainer(EventHandler):
             self.numerauto.config['prediction_directory'] = './predictions'
         if 'model_directory' not in self.numerauto.config:
             self.numerauto.config['model_directory'] = './models'
+        if 'model_cache' not in self.numerauto.config:
+            self.numerauto.config['model_cache'] = True
+        if 'full_retrain_interval' not in self.numerauto.config:
+            self.numerauto.config['full_retrain_interval'] = 4
             
         # Turn model and prediction directory into pathlib Path
         self.numerauto.config['prediction_directory'] = Path(self.numerauto.config['prediction_directory'])
         self.numerauto.config['model_directory'] = Path(self.numerauto.config['model_directory'])
 
+        self.artifacts = ArtifactStore(self.numerauto.config['model_directory'])
+        # Remove blobs of model files that were removed
+        self.artifacts.collect_garbage()
+
+    def _get_incremental_update(self, round_number):
+        """
+        Get the model of the last round trained and the eras to update it
+        with, if the model can be updated incrementally.
+
+        Returns:
+            Tuple of the model and the list of added eras, or (None, None) if
+            the model must be trained from scratch.
+        """
+
+        last_round_trained = self.numerauto.get_last_round_trained(self.tournament_id)
+        if not self.incremental or last_round_trained is None:
+            return None, None
+
+        changes = self.numerauto.get_dataset_changes(last_round_trained, round_number, 'numerai_training_data.csv')
+        if changes is None or changes['changed'] or changes['removed']:
+            logger.info('SKLearnModelTrainer(%s): Full retrain because existing training data changed', self.name)
+            return None, None
+
+        # Keeping the model if there are no new eras is not an update
+        updates = self.numerauto.persistent_state.get('incremental_updates', {}).get(self.name, 0)
+        interval = self.numerauto.config['full_retrain_interval']
+        if changes['added'] and interval and updates + 1 >= interval:
+            logger.info('SKLearnModelTrainer(%s): Full retrain after %d incremental updates', self.name, updates)
+            return None, None
+
+        tournament_name = self.numerauto.tournaments[self.tournament_id]
+        model_filename = self.numerauto.config['model_directory'] / 'tournament_{}/round_{}/{}.p'.format(
+            tournament_name, last_round_trained, self.name)
+        try:
+            model = self._get_model(self.name, model_filename)
+        except FileNotFoundError:
+            logger.warning('SKLearnModelTrainer(%s): Model of round %d not found', self.name, last_round_trained)
+            return None, None
+
+        if not hasattr(model, 'partial_fit') and not self._can_warm_start(model):
+            logger.info('SKLearnModelTrainer(%s): Full retrain because the model can not be updated', self.name)
+            return None, None
+
+        return model, changes['added']
+
+    def _can_warm_start(self, model):
+        """ Check whether a model is an ensemble that can be updated with warm_start """
+
+        params = getattr(model, 'get_params', dict)()
+        return bool(self.warm_start_estimators) and 'warm_start' in params and 'n_estimators' in params
+
     def on_new_training_data(self, round_number):
         tournament_name = self.numerauto.tournaments[self.tournament_id]
         
-        train_x = pd.read_csv(self.numerauto.get_dataset_path(round_number) / 'numerai_training_data.csv', header=0)
+        train_x = self.numerauto.load_dataset(round_number, 'numerai_training_data.csv')
         target_columns = set([x for x in list(train_x) if x[0:7] == 'target_'])
 
+        model, added_eras = self._get_incremental_update(round_number)
+        if model is not None:
+            train_x = train_x[train_x['era'].isin(added_eras).to_numpy()]
+
         train_y = train_x['target_' + tournament_name].values
         train_x = train_x.drop({'id', 'era', 'data_type'} | target_columns, axis=1).values
 
-        logger.info('SKLearnModelTrainer(%s): Fitting model for tournament %s round %d',
-                    self.name, tournament_name, round_number)
-        model = self.model_factory()
-        model.fit(train_x, train_y)
+        updates = self.numerauto.persistent_state.setdefault('incremental_updates', {})
+        if model is None:
+            logger.info('SKLearnModelTrainer(%s): Fitting model for tournament %s round %d',
+                        self.name, tournament_name, round_number)
+            model = self.model_factory()
+            model.fit(train_x, train_y)
+            updates[self.name] = 0
+        elif len(train_y) == 0:
+            # E.g. only the validation data changed: the model of the last
+            # round trained is kept, which does not count as an update
+            logger.info('SKLearnModelTrainer(%s): No new eras for tournament %s round %d, keeping the previous model',
+                        self.name, tournament_name, round_number)
+            self.numerauto.report['training'][tournament_name][self.name]['added_eras'] = []
+        else:
+            logger.info('SKLearnModelTrainer(%s): Updating model for tournament %s round %d with %d new eras',
+                        self.name, tournament_name, round_number, len(added_eras))
+            if hasattr(model, 'partial_fit'):
+                model.partial_fit(train_x, train_y)
+            else:
+                # Fit additional estimators on the added eras only
+                model.set_params(warm_start=True,
+                                 n_estimators=model.get_params()['n_estimators'] + self.warm_start_estimators)
+                model.fit(train_x, train_y)
+            updates[self.name] = updates.get(self.name, 0) + 1
+            self.numerauto.report['training'][tournament_name][self.name]['added_eras'] = added_eras
 
         ensure_directory_exists(self.numerauto.config['model_directory'] / 'tournament_{}/round_{}'.format(tournament_name, round_number))
         model_filename = self.numerauto.config['model_directory'] / 'tournament_{}/round_{}/{}.p'.format(tournament_name, round_number, self.name)
-        pickle.dump(model, open(model_filename, 'wb'))
+        # Numerauto waits for the model to be written before the round is
+        # marked as trained
+        self._models[self.name] = (model_filename, model)
+        self.numerauto.submit_background_task('{}: write model'.format(self.name), self.artifacts.save,
+                                              model, model_filename)
         
         self.numerauto.report['training'][tournament_name][self.name]['filename'] = model_filename
 
+    def _get_model(self, model_name, model_filename):
+        """
+        Get a model from memory, or load it from file if it is not in memory.
+
+        Args:
+            model_name: Name of the model.
+            model_filename: Filename of the model.
+
+        Returns:
+            The model.
+        """
+
+        if model_name in self._models and self._models[model_name][0] == model_filename:
+            return self._models[model_name][1]
+
+        logger.info('SKLearnModelTrainer(%s): Loading model %s', self.name, model_filename)
+        model = self.artifacts.load(model_filename)
+        self._models[model_name] = (model_filename, model)
+
+        return model
+
+    def _report_prediction_file(self, tournament_name, name):
+        """ Get a callback that reports the filename of a written predictions file """
+
+        def callback(filename):
+            self.numerauto.report['predictions'][tournament_name][name]['filename'] = filename
+        return callback
+
+    def on_cleanup(self, round_number):
+        if not self.numerauto.config['model_cache']:
+            self._models = {}
+
 
     def on_new_tournament_data(self, round_number):
         tournament_name = self.numerauto.tournaments[self.tournament_id]
 
-        test_x = pd.read_csv(self.numerauto.get_dataset_path(round_number) / 'numerai_tournament_data.csv', header=0)
+        test_x = self.numerauto.load_dataset(round_number, 'numerai_tournament_data.csv')
         target_columns = set([x for x in list(test_x) if x[0:7] == 'target_'])
 
         test_ids = test_x['id']
@@ -151,26 +313,142 @@ class SKLearnModelTrainer(EventHandler):
         logger.info('SKLearnModelTrainer(%s): Applying model for tournament %s round %d',
                     self.name, tournament_name, round_number)
         model_filename = self.numerauto.config['model_directory'] / 'tournament_{}/round_{}/{}.p'.format(
-            tournament_name, self.numerauto.persistent_state['last_round_trained'], self.name)
-        model = pickle.load(open(model_filename, 'rb'))
+            tournament_name, self.numerauto.get_last_round_trained(self.tournament_id), self.name)
+        model = self._get_model(self.name, model_filename)
         predictions = model.predict(test_x)
 
-        df = pd.DataFrame(predictions, columns=['prediction_' + tournament_name], index=test_ids)
         ensure_directory_exists(self.numerauto.config['prediction_directory'] / 'tournament_{}/round_{}'.format(tournament_name, round_number))
-        df.to_csv(self.numerauto.config['prediction_directory'] / 'tournament_{}/round_{}/{}.csv'.format(tournament_name, round_number, self.name),
-                  index_label='id', float_format='%.8f')
-        
-        self.numerauto.report['predictions'][tournament_name][self.name + '.csv']['filename'] = self.numerauto.config['prediction_directory'] / 'tournament_{}/round_{}/{}.csv'.format(tournament_name, round_number, self.name)
+        # The filename is reported once the predictions file has been written
+        self.numerauto.predictions.publish(
+            self.tournament_id, self.name + '.csv', test_ids.to_numpy(), predictions,
+            self.numerauto.config['prediction_directory'] / 'tournament_{}/round_{}/{}.csv'.format(tournament_name, round_number, self.name),
+            'prediction_' + tournament_name, callback=self._report_prediction_file(tournament_name, self.name + '.csv'))
+
+
+def _fit_model_process(model_factory, train_x_filename, train_y_filename, artifacts, model_filename):
+    """
+    Fit a model on a memory-mapped training matrix and save it to an artifact
+    store. Executed in a worker process by SKLearnMultiModelTrainer.
+    """
+
+    train_x = np.load(train_x_filename, mmap_mode='r')
+    train_y = np.load(train_y_filename, mmap_mode='r')
+
+    model = model_factory()
+    model.fit(train_x, train_y)
+
+    return artifacts.save(model, model_filename)
+
+
+class SKLearnMultiModelTrainer(SKLearnModelTrainer):
+    """
+    Event handler that trains and applies multiple models that adhere to the
+    sklearn API in a process pool.
+
+    The training matrix is loaded once and written to a temporary file that
+    every worker process memory-maps, so that all processes share a single
+    copy of the data. The models are stored and applied like those of
+    SKLearnModelTrainer, using the model name instead of the handler name:
+        ./models/tournament_<name>/round_<num>/<model name>.p
+        ./predictions/tournament_<name>/round_<num>/<model name>.csv
+    The models are written to file by the worker processes, and are kept in
+    memory once they have been loaded to apply them.
+
+    Note that the model factories are sent to the worker processes, so they
+    must be picklable: use a class or functools.partial instead of a lambda.
+    On platforms that start worker processes by spawning a new interpreter
+    (Windows, macOS), the script that runs Numerauto must be guarded by
+    if __name__ == '__main__'.
+    """
+
+    def __init__(self, name, model_factories, tournament_id=None, workers=None, dependencies=None):
+        """
+        Creates a new SKLearnMultiModelTrainer instance.
+
+        Args:
+            name: Event handler name.
+            model_factories: Dictionary mapping model names to picklable
+                             functions that create a new model instance.
+            tournament_id: ID of the tournament to upload predictions to. The default None will copy the tournament id of the Numerauto instance
+            workers: Number of worker processes (default: None, i.e. the number of CPUs)
+            dependencies: List of names of event handlers this handler depends on.
+        """
+
+        super().__init__(name, None, tournament_id=tournament_id, dependencies=dependencies)
+        self.model_factories = model_factories
+        self.workers = workers
+
+    def on_new_training_data(self, round_number):
+        tournament_name = self.numerauto.tournaments[self.tournament_id]
+
+        train_x = self.numerauto.load_dataset(round_number, 'numerai_training_data.csv')
+        target_columns = set([x for x in list(train_x) if x[0:7] == 'target_'])
+
+        train_y = train_x['target_' + tournament_name].values
+        train_x = train_x.drop({'id', 'era', 'data_type'} | target_columns, axis=1).values
+
+        model_path = self.numerauto.config['model_directory'] / 'tournament_{}/round_{}'.format(tournament_name, round_number)
+        ensure_directory_exists(model_path)
+
+        with tempfile.TemporaryDirectory(dir=self.numerauto.config['model_directory']) as tmp_path:
+            train_x_filename = os.path.join(tmp_path, 'train_x.npy')
+            train_y_filename = os.path.join(tmp_path, 'train_y.npy')
+            np.save(train_x_filename, np.ascontiguousarray(train_x))
+            np.save(train_y_filename, train_y)
+            del train_x, train_y
+
+            logger.info('SKLearnMultiModelTrainer(%s): Fitting %d models for tournament %s round %d',
+                        self.name, len(self.model_factories), tournament_name, round_number)
+
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+                futures = {model_name: pool.submit(_fit_model_process, model_factory,
+                                                   train_x_filename, train_y_filename, self.artifacts,
+                                                   model_path / '{}.p'.format(model_name))
+                           for model_name, model_factory in self.model_factories.items()}
+
+                for model_name, future in futures.items():
+                    model_filename = future.result()
+                    logger.info('SKLearnMultiModelTrainer(%s): Finished fitting model %s',
+                                self.name, model_name)
+                    self.numerauto.report['training'][tournament_name][model_name]['filename'] = model_filename
+
+    def on_new_tournament_data(self, round_number):
+        tournament_name = self.numerauto.tournaments[self.tournament_id]
+
+        test_x = self.numerauto.load_dataset(round_number, 'numerai_tournament_data.csv')
+        target_columns = set([x for x in list(test_x) if x[0:7] == 'target_'])
+
+        test_ids = test_x['id']
+        test_x = test_x.drop({'id', 'era', 'data_type'} | target_columns, axis=1).values
+
+        prediction_path = self.numerauto.config['prediction_directory'] / 'tournament_{}/round_{}'.format(tournament_name, round_number)
+        ensure_directory_exists(prediction_path)
+
+        for model_name in self.model_factories:
+            logger.info('SKLearnMultiModelTrainer(%s): Applying model %s for tournament %s round %d',
+                        self.name, model_name, tournament_name, round_number)
+            model_filename = self.numerauto.config['model_directory'] / 'tournament_{}/round_{}/{}.p'.format(
+                tournament_name, self.numerauto.get_last_round_trained(self.tournament_id), model_name)
+            model = self._get_model(model_name, model_filename)
+            predictions = model.predict(test_x)
+
+            self.numerauto.predictions.publish(self.tournament_id, model_name + '.csv', test_ids.to_numpy(), predictions,
+                                               prediction_path / '{}.csv'.format(model_name), 'prediction_' + tournament_name,
+                                               callback=self._report_prediction_file(tournament_name, model_name + '.csv'))
 
 
 class PredictionUploader(EventHandler):
     """
     Event handler that uploads a predictions file from the
     numerauto.config['prediction_directory'] directory (defaults to ./predictions)
-    using the Numerai API.
+    using the Numerai API. If the predictions were published in the prediction
+    registry of the round, the file is written if that has not happened yet.
     """
 
-    def __init__(self, name, filename, public_id, secret_key, tournament_id=None, verify_upload=True):
+    dataset_files = []
+
+    def __init__(self, name, filename, public_id, secret_key, tournament_id=None, verify_upload=True,
+                 dependencies=None):
         """
         Creates a new PredictionUploader instance.
 
@@ -180,8 +458,10 @@ class PredictionUploader(EventHandler):
             public_id: Numerai public API key for the account the prediction is uploaded to.
             secret_key: Numerai secret API key for the account the prediction is uploaded to.
             tournament_id: ID of the tournament to upload predictions to. The default None will copy the tournament id of the Numerauto instance
+            dependencies: List of names of event handlers this handler depends on,
+                          typically the handler that generates the predictions file.
         """
-        super().__init__(name)
+        super().__init__(name, dependencies)
         self.filename = filename
         self.public_id = public_id
         self.secret_key = secret_key
@@ -203,15 +483,40 @@ class PredictionUploader(EventHandler):
         self.numerauto.config['prediction_directory'] = Path(self.numerauto.config['prediction_directory'])
 
     def on_new_tournament_data(self, round_number):
+        tournament_name = self.numerauto.tournaments[self.tournament_id]
+        prediction_path = self.numerauto.config['prediction_directory'] / 'tournament_{}/round_{}/'.format(tournament_name, round_number)
+
+        # Upload and verify in the background, so that uploads of multiple
+        # uploaders run concurrently and do not block other event handlers
+        self.numerauto.submit_background_task('PredictionUploader({})'.format(self.name),
+                                              self._upload_predictions, round_number, tournament_name, prediction_path,
+                                              self.numerauto.predictions,
+                                              callback=lambda x: self._report_submission(tournament_name, x))
+
+    def _upload_predictions(self, round_number, tournament_name, prediction_path, registry):
+        """
+        Upload and optionally verify the predictions file. Executed as a
+        background task.
+
+        Args:
+            round_number: Number of the round.
+            tournament_name: Name of the tournament.
+            prediction_path: Directory of the predictions file.
+            registry: PredictionRegistry of the round.
+
+        Returns:
+            Dictionary with the submission details for the round report, or
+            None if the upload failed.
+        """
+
         logger.info('PredictionUploader(%s): Uploading predictions for round %d: %s',
                     self.name, round_number, self.filename)
-        napi = RobustNumerAPI(public_id=self.public_id, secret_key=self.secret_key,
-                              retry_wait_schedule=self.numerauto.config['napi_wait_schedule'])
+        napi = self.numerauto.get_api_client(self.public_id, self.secret_key)
 
-        tournament_name = self.numerauto.tournaments[self.tournament_id]
+        # Make sure published predictions are written to file
+        registry.get_file(self.tournament_id, self.filename)
 
         try:
-            prediction_path = self.numerauto.config['prediction_directory'] / 'tournament_{}/round_{}/'.format(tournament_name, round_number)
             submission_id = napi.upload_predictions(prediction_path / self.filename, tournament=self.tournament_id)
             print(submission_id)
             
@@ -228,24 +533,30 @@ class PredictionUploader(EventHandler):
                 logger.info('PredictionUploader(%s): Upload verified: Correlation: %.4f Consistency: %.1f Concordance: %r',
                             self.name, status['validationCorrelation'], status['consistency'], status['concordance']['value'])
                 
-                self.numerauto.report['submissions'][tournament_name][self.filename] = {
-                        'submission_id': submission_id,
+                return {'submission_id': submission_id,
                         'filename': prediction_path / self.filename,
                         'validationCorrelation': status['validationCorrelation'],
                         'consistency': status['consistency'],
                         'concordance': status['concordance']['value']}
             else:
-                self.numerauto.report['submissions'][tournament_name][self.filename] = {
-                    'submission_id': submission_id,
-                    'filename': prediction_path / self.filename}
+                return {'submission_id': submission_id,
+                        'filename': prediction_path / self.filename}
                 
         except NumerAPIError as e:
             logger.error('PredictionUploader(%s): NumerAPI exception in tournament %s round %d: %s',
                          self.name, tournament_name, round_number, e)
             logger.error('PredictionUploader(%s): Predictions not uploaded successfully, '
-                         'please upload %s manually, or remove state.pickle and restart '
+                         'please upload %s manually, or remove the state database and restart '
                          'Numerauto to process this round again', self.name, prediction_path / self.filename)
 
+        return None
+
+    def _report_submission(self, tournament_name, submission):
+        """ Write the result of the upload background task to the report """
+
+        if submission is not None:
+            self.numerauto.report['submissions'][tournament_name][self.filename] = submission
+
 
 
 class CommandlineExecutor(EventHandler):
@@ -254,7 +565,8 @@ class CommandlineExecutor(EventHandler):
     data.
     """
 
-    def __init__(self, name, on_new_training_commandline=None, on_new_tournament_commandline=None):
+    def __init__(self, name, on_new_training_commandline=None, on_new_tournament_commandline=None,
+                 dependencies=None):
         """
         Creates a new CommandlineExecutor instance.
         The command lines provided in the arguments will have the substring
@@ -265,8 +577,9 @@ class CommandlineExecutor(EventHandler):
             name: Event handler name.
             on_new_training_commandline: Command line to execute when new training data is available.
             on_new_tournament_commandline: Command line to execute when new tournament data is available.
+            dependencies: List of names of event handlers this handler depends on.
         """
-        super().__init__(name)
+        super().__init__(name, dependencies)
         self.on_new_training_commandline = on_new_training_commandline
         self.on_new_tournament_commandline = on_new_tournament_commandline
 
@@ -293,11 +606,15 @@ class CommandlineExecutor(EventHandler):
 class PredictionStatisticsGenerator(EventHandler):
     """
     Event handler that generates statistics for a given prediction filename and
-    stores them in the numerauto report dictionary.
+    stores them in the numerauto report dictionary. Predictions published in
+    the prediction registry of the round are used directly, other predictions
+    are read from file.
     """
-    
-    def __init__(self, name, filename, tournament_id=None):
-        super().__init__(name)
+
+    dataset_files = ['numerai_tournament_data.csv']
+
+    def __init__(self, name, filename, tournament_id=None, dependencies=None):
+        super().__init__(name, dependencies)
         self.filename = filename
         self.tournament_id = tournament_id
         
@@ -313,26 +630,31 @@ class PredictionStatisticsGenerator(EventHandler):
 
     def on_new_tournament_data(self, round_number):
         tournament_name = self.numerauto.tournaments[self.tournament_id]
+        target_column = 'target_' + tournament_name
+        prediction_column = 'prediction_' + tournament_name
+
+        test_df = self.numerauto.load_dataset(round_number, 'numerai_tournament_data.csv',
+                                              columns=['id', 'era', 'data_type', target_column])
+        test_df = test_df[test_df['data_type'] == 'validation']
+
+        # Use the predictions published in this round, or read them from file
+        # if they were generated outside of Numerauto
+        predictions = self.numerauto.predictions.get(self.tournament_id, self.filename)
+        if predictions is None:
+            prediction_path = self.numerauto.config['prediction_directory'] / 'tournament_{}/round_{}/'.format(tournament_name, round_number)
+            predictions = pd.read_csv(prediction_path / self.filename, header=0, index_col='id')[prediction_column]
+
+        # Match predictions to the validation rows by id
+        predictions = predictions.reindex(test_df['id'].to_numpy()).to_numpy()
 
-        test_df = pd.read_csv(self.numerauto.get_dataset_path(round_number) / 'numerai_tournament_data.csv', header=0)
-        
-        prediction_path = self.numerauto.config['prediction_directory'] / 'tournament_{}/round_{}/'.format(tournament_name, round_number)
-        p_df = pd.read_csv(prediction_path / self.filename, header=0)
-        
-        val_eras = test_df[test_df['data_type'] == 'validation']['era'].unique()
-        
-        # TODO: sort by id
         d = self.numerauto.report['predictions'][tournament_name][self.filename]
-        
-        consistency = 0
-        for e in val_eras:
-            d['validationCorrelation'][e] = spearmanr(test_df[test_df['era'] == e]['target_' + tournament_name],
-                                                  p_df[test_df['era'] == e]['prediction_' + tournament_name])[0]
-            consistency += d['validationCorrelation'][e] > 0
 
-        d['validationCorrelation']['overall'] = spearmanr(test_df[test_df['data_type'] == 'validation']['target_' + tournament_name],
-                                                      p_df[test_df['data_type'] == 'validation']['prediction_' + tournament_name])[0]
-        d['consistency'] = consistency / len(val_eras)
+        era_correlations = spearman_by_era(test_df['era'], test_df[target_column], predictions)
+        for e, correlation in era_correlations.items():
+            d['validationCorrelation'][e] = correlation
+
+        d['validationCorrelation']['overall'] = spearman_by_era(np.zeros(len(test_df)), test_df[target_column], predictions).iloc[0]
+        d['consistency'] = (era_correlations > 0).sum() / len(era_correlations)
 
 
 
@@ -341,7 +663,9 @@ class BasicReportWriter(EventHandler):
     Event handler that writes the numerauto report dictionary to a basic report
     file.
     """
-    
+
+    dataset_files = []
+
     def on_start(self):
         if 'report_directory' not in self.numerauto.config:
             self.numerauto.config['report_directory'] = './reports'
@@ -374,9 +698,12 @@ class BasicReportEmailer(EventHandler):
     Event handler that emails the numerauto report dictionary as an email with
     simple formatting.
     """
-    
-    def __init__(self, name, smtp_server, smtp_port, smtp_user, smtp_password, email_from, email_to, smtp_tls=True):
-        super().__init__(name)
+
+    dataset_files = []
+
+    def __init__(self, name, smtp_server, smtp_port, smtp_user, smtp_password, email_from, email_to, smtp_tls=True,
+                 dependencies=None):
+        super().__init__(name, dependencies)
         
         self.smtp_server = smtp_server
         self.smtp_port = smtp_port
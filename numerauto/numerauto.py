@@ -7,8 +7,17 @@ import datetime
 import signal
 import sys
 import os
+import random
+import re
+import fnmatch
+import time
 import shutil
+import zipfile
 import collections
+import copy
+import threading
+import contextlib
+import concurrent.futures
 from pathlib import Path
 import logging
 
@@ -16,9 +25,17 @@ import requests
 import pytz
 import dateutil
 
-from .robust_numerapi import RobustNumerAPI
-from .utils import check_dataset
+from .robust_numerapi import RobustNumerAPI, create_session
+from .utils import check_dataset, get_dataset_changes, Measurement
+from . import datasets
+from .download import get_remote_info, download_file, is_same_file
+from .download import read_download_info, write_download_info, compute_file_info, get_info_filename
 from .utils import wait, wait_until
+from .scheduler import get_scheduler
+from .predictions import PredictionRegistry
+from .datastore import DatasetStore, get_disk_usage
+from .statestore import StateStore
+from .profiling import create_profiler
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +44,35 @@ logger = logging.getLogger(__name__)
 nested_defaultdict = lambda: collections.defaultdict(nested_defaultdict)
 
 
+def merge_report(report, changes, original):
+    """
+    Merge the entries of a report dictionary that were changed with respect to
+    an original copy into another report dictionary.
+
+    Args:
+        report: Report dictionary to merge the changes into.
+        changes: Changed copy of the report dictionary.
+        original: Original copy of the report dictionary.
+    """
+
+    for key, value in changes.items():
+        original_value = original[key] if isinstance(original, dict) and key in original else None
+
+        if isinstance(value, dict) and key in report and isinstance(report[key], dict):
+            merge_report(report[key], value, original_value if isinstance(original_value, dict) else {})
+            continue
+
+        if isinstance(original, dict) and key in original:
+            try:
+                if original_value is value or bool(original_value == value):
+                    continue
+            except ValueError:
+                # Comparison of e.g. numpy arrays, assume changed
+                pass
+
+        report[key] = value
+
+
 class InterruptedException(Exception):
     """ Exception that is raised by our signal handler. """
     pass
@@ -35,6 +81,9 @@ def signal_handler(signum, frame):
     """ SIGINT/SIGTERM handler """
 
     logger.info('Signal received, exiting!')
+
+    # Wake up waits in other threads, e.g. retries of background tasks
+    get_scheduler().cancel()
     raise InterruptedException()
 
 
@@ -49,49 +98,147 @@ class Numerauto:
 
     See numerauto.handlers for some basic event handlers.
 
+    A single instance can process multiple tournaments that share the same
+    dataset. The dataset is downloaded and checked once per round, while the
+    last round processed and trained are tracked per tournament. Event handlers
+    with a tournament_id attribute only receive the events of their tournament.
+
     Attributes:
         tournament_id: Numerai tournament id for which this instance will download data.
+        tournament_ids: Ids of the tournaments processed by this instance. The
+                        tournaments of the event handlers are processed as well.
         napi: A robust version of NumerAPI (note that no API keys are supplied)
+        session: requests Session shared by all Numerai API clients of this instance
+        dataset_store: DatasetStore that deduplicates the dataset files of all rounds
         event_handlers: List of event handlers that are bound to this instance.
         persistent_state: Internal storage of the current state of the daemon.
+        state_store: StateStore in which the persistent state and round history
+                     are saved (None until the state is loaded)
         round_number: Current round number.
         tournaments: Dictionary mapping tournament ID to tournament name
         report: Dictionary that event handlers can write to during round processing.
+        predictions: PredictionRegistry of the round that is being processed
+                     (None outside round processing)
         config: Dictionary that contains all Numerauto configuration entries
     """
 
-    def __init__(self, tournament_id=8, config={}):
+    @property
+    def report(self):
+        """
+        Dictionary that event handlers can write to during round processing.
+        While handlers are executed in parallel, each handler sees its own
+        copy of the report, which is merged into the round report in handler
+        order after the handler finishes.
+        """
+
+        report = getattr(self._handler_context, 'report', None)
+        return report if report is not None else self._report
+
+    @report.setter
+    def report(self, value):
+        self._report = value
+
+    def __init__(self, tournament_id=8, config={}, tournament_ids=None):
         """
         Creates a Numerauto instance.
 
         Args:
             tournament_id: Numerai tournament id for which this instance will download data.
             config: Dictionary containing configuration entries to replace the default values
+            tournament_ids: List of ids of the tournaments to process (default:
+                            None, i.e. only tournament_id and the tournaments
+                            of the event handlers)
         """
         self.tournament_id = tournament_id
+        self.tournament_ids = [tournament_id]
+        if tournament_ids is not None:
+            self.tournament_ids += [x for x in tournament_ids if x != tournament_id]
         self.event_handlers = []
         self.persistent_state = None
+        self.state_store = None
         self.round_number = None
         self.tournaments = None
-        self.report = None
+        self._report = None
+        self._handler_context = threading.local()
+        self.predictions = None
         
         self.config = {
                 # Directory to store data
                 'data_directory': './data',
                 # Include validation data when checking for new training data
                 'check_validation_data': True,
+                # Method used to check for new data: 'fingerprint' compares
+                # digests of the rows, 'chunked' streams through the data and
+                # stops at the first difference, 'full' loads and compares
+                # both datasets
+                'check_dataset_method': 'fingerprint',
+                # Convert each downloaded dataset once to a memory-mappable
+                # columnar cache that is used by load_dataset
+                'dataset_cache': True,
+                # dtype of the feature columns returned by load_dataset:
+                # 'float32', 'float64', or 'uint8' (quantized feature codes)
+                'feature_dtype': 'float32',
+                # Check the live data directly from the downloaded archive, and
+                # only extract the data files required by the event handlers
+                # once the dataset is known to be new
+                'selective_extraction': True,
+                # Keep each distinct dataset file once in a content-addressed
+                # store, linked into the dataset directories of the rounds
+                'dataset_store': True,
+                # Maximum number of bytes used by the data directory. The datasets
+                # of the oldest rounds are removed when it is exceeded, except the
+                # current round and the rounds last trained on. None disables removal.
+                'dataset_disk_budget': None,
                 # Seconds before planned round start to wake up and start checking
                 # if new round has started.
                 'wakeup_time': 360,
-                # Seconds to wait between each check for the new round.
+                # Maximum seconds to wait between each check for the new round.
+                # The interval is halved as the round close time approaches, and
+                # grows again from 'round_wait_min_interval' if the round is delayed.
                 'round_wait_interval': 60,
+                # Minimum seconds to wait between each check for the new round.
+                'round_wait_min_interval': 5,
+                # Random variation of the waiting time between checks for a delayed
+                # round, as a fraction of the waiting time.
+                'round_wait_jitter': 0.2,
                 # If a dataset was downloaded that was not new, wait this many seconds
                 # before downloading the dataset again.
                 'invalid_dataset_waittime': 600,
                 # In single_run mode, maximum seconds to wait for a new round
                 'single_run_max_wait': 86400,
                 # Incremental waiting times for failed RobustNumerAPI queries (5x 1 minute, 3x 10 minutes, 3x 1 hour)
-                'napi_wait_schedule': [60, 60, 60, 60, 60, 600, 600, 600, 3600, 3600, 3600]
+                'napi_wait_schedule': [60, 60, 60, 60, 60, 600, 600, 600, 3600, 3600, 3600],
+                # Maximum number of keep-alive connections shared by all Numerai API clients
+                'napi_pool_size': 10,
+                # Timeout in seconds for Numerai API queries (or a (connect, read) tuple)
+                'napi_timeout': 60,
+                # Number of concurrent connections used to download the dataset
+                # archive, if the server supports range requests
+                'download_connections': 4,
+                # Number of event handlers that may be executed in parallel. Handlers
+                # are only started once the handlers they depend on have finished.
+                'handler_workers': 1,
+                # Number of threads that execute background tasks, such as prediction uploads
+                'background_workers': 4,
+                # Maximum number of seconds to wait for background tasks after
+                # training and at the end of a round
+                'background_task_timeout': 7200,
+                # Write the predictions published by event handlers to file in the
+                # background. If False, files are only written when requested
+                # (e.g. for upload).
+                'write_prediction_files': True,
+                # SQLite database in which the persistent state and the history of
+                # all rounds and event handler calls are stored. A state.pickle
+                # file of an older version is migrated automatically.
+                'state_filename': 'state.db',
+                # Event handler calls to profile, as '<handler name>.<event>' patterns
+                # with wildcards, e.g. ['trainer.on_new_training_data', '*.on_cleanup'].
+                # Profiles are written to the report directory.
+                'profile': [],
+                # Profiler to use: 'cprofile' or 'sampling' (see numerauto.profiling)
+                'profiler': 'cprofile',
+                # Seconds between the samples of the sampling profiler
+                'profile_interval': 0.005
                 }
         
         # Add/replace user-defined config entries
@@ -100,8 +247,31 @@ class Numerauto:
         # Change data directory into a pathlib Path
         self.config['data_directory'] = Path(self.config['data_directory'])
         
+        # Connection pool shared by all API clients of this instance and its handlers
+        self.session = create_session(self.config['napi_pool_size'])
+
         self.napi = RobustNumerAPI(verbosity='warning', show_progress_bars=False,
-                                   retry_wait_schedule=self.config['napi_wait_schedule'])
+                                   retry_wait_schedule=self.config['napi_wait_schedule'],
+                                   session=self.session, timeout=self.config['napi_timeout'])
+
+        self.dataset_store = DatasetStore(self.config['data_directory'])
+
+        # Authenticated API clients by public id, see get_api_client
+        self._api_clients = {}
+        self._api_clients_lock = threading.Lock()
+
+        # Background tasks of the current round, see submit_background_task
+        self._background_executor = None
+        self._background_tasks = []
+        # Event handlers executed in parallel may submit tasks concurrently
+        self._background_lock = threading.Lock()
+
+        # Durations of processing phases before the round report exists, see _measure_phase
+        self._phase_timings = {}
+
+        # Round history and event handler calls that have not been saved yet
+        self._history = {'rounds': [], 'handler_events': []}
+        self._history_lock = threading.Lock()
 
 
     def add_event_handler(self, handler):
@@ -129,122 +299,608 @@ class Numerauto:
 
         self.event_handlers = [h for h in self.event_handlers if h.name != handler_name]
 
+    def get_api_client(self, public_id=None, secret_key=None):
+        """
+        Get a Numerai API client for an account. Clients are created once per
+        public id and reused by all event handlers and in every round. All
+        clients share the connection pool of this instance.
+
+        Args:
+            public_id: Numerai public API key (default: None, i.e. the
+                       unauthenticated client of this instance)
+            secret_key: Numerai secret API key.
+
+        Returns:
+            RobustNumerAPI instance.
+        """
+
+        if public_id is None:
+            return self.napi
+
+        with self._api_clients_lock:
+            napi = self._api_clients.get(public_id)
+
+            # Replace the client if the secret key has changed
+            if napi is None or napi.token != (public_id, secret_key):
+                logger.debug('get_api_client: Creating API client for %s', public_id)
+                napi = RobustNumerAPI(public_id=public_id, secret_key=secret_key,
+                                      retry_wait_schedule=self.config['napi_wait_schedule'],
+                                      session=self.session, timeout=self.config['napi_timeout'])
+                self._api_clients[public_id] = napi
+
+            return napi
+
+    def submit_background_task(self, name, function, *args, callback=None):
+        """
+        Execute a function in a background thread. Background tasks of a round
+        are waited for after on_new_training_data (before the round is marked
+        as trained) and at the end of the round, before on_cleanup is
+        triggered, with a maximum of 'background_task_timeout' seconds.
+
+        Args:
+            name: Name of the task, used for logging.
+            function: Function to execute.
+            args: Arguments for the function.
+            callback: Function that is called with the return value of the
+                      task when it has finished. Callbacks are called from the
+                      main thread, in the order in which the tasks were
+                      submitted, and may write to the round report.
+
+        Returns:
+            concurrent.futures Future of the task.
+        """
+
+        logger.debug('submit_background_task(%s)', name)
+        with self._background_lock:
+            if self._background_executor is None:
+                self._background_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.config['background_workers'], thread_name_prefix='numerauto-background')
+
+            future = self._background_executor.submit(function, *args)
+            self._background_tasks.append((name, future, callback))
+        return future
+
+    def wait_for_background_tasks(self, timeout=None):
+        """
+        Wait for all submitted background tasks and call their callbacks.
+        Tasks that do not finish before the timeout are abandoned.
+
+        Args:
+            timeout: Maximum number of seconds to wait (default: None, i.e. no limit)
+
+        Returns:
+            List of names of the tasks that failed or did not finish.
+        """
+
+        with self._background_lock:
+            tasks = self._background_tasks
+            self._background_tasks = []
+
+        if not tasks:
+            return []
+
+        logger.info('Waiting for %d background tasks', len(tasks))
+        done, not_done = concurrent.futures.wait([x[1] for x in tasks], timeout=timeout)
+
+        failed = []
+        for name, future, callback in tasks:
+            if future not in done:
+                logger.error('Background task %s did not finish within %s seconds', name, timeout)
+                failed.append(name)
+            elif future.exception() is not None:
+                logger.error('Background task %s failed: %r', name, future.exception())
+                failed.append(name)
+            elif callback is not None:
+                callback(future.result())
+
+        return failed
+
+    def _get_sorted_event_handlers(self):
+        """
+        Get the event handlers sorted such that every handler comes after the
+        handlers it depends on. Otherwise, handlers stay in the order in which
+        they were added.
+        """
+
+        names = set(h.name for h in self.event_handlers)
+        for h in self.event_handlers:
+            for dependency in h.dependencies:
+                if dependency not in names:
+                    raise ValueError('Event handler {} depends on unknown event handler {}'.format(
+                        h.name, dependency))
+
+        handlers = []
+        remaining = list(self.event_handlers)
+        while remaining:
+            pending = set(h.name for h in remaining)
+            for h in remaining:
+                if not any(d in pending for d in h.dependencies):
+                    handlers.append(h)
+                    remaining.remove(h)
+                    break
+            else:
+                raise ValueError('Event handlers have circular dependencies: {}'.format(
+                    ', '.join(h.name for h in remaining)))
+
+        return handlers
+
+    def get_processed_tournament_ids(self):
+        """
+        Get the ids of all tournaments processed by this instance: the
+        tournament_ids of the instance and the tournaments of the event
+        handlers.
+
+        Returns:
+            List of tournament ids.
+        """
+
+        tournament_ids = list(self.tournament_ids)
+        for h in self.event_handlers:
+            tournament_id = getattr(h, 'tournament_id', None)
+            if tournament_id is not None and tournament_id not in tournament_ids:
+                tournament_ids.append(tournament_id)
+
+        return tournament_ids
+
+    def get_last_round_trained(self, tournament_id=None):
+        """
+        Get the last round in which new training data was signalled for a
+        tournament.
+
+        Args:
+            tournament_id: Id of the tournament (default: None, i.e. the
+                           tournament_id of this instance)
+
+        Returns:
+            Round number, or None if training has not been performed.
+        """
+
+        if tournament_id is None:
+            tournament_id = self.tournament_id
+
+        state = self.persistent_state['tournament_state'].get(tournament_id)
+        return state['last_round_trained'] if state is not None else None
+
+    def _set_tournament_state(self, tournament_ids, key, round_number):
+        """
+        Set the last round processed or trained of tournaments, and keep the
+        global entry of the persistent state up to date for the tournament of
+        this instance.
+        """
+
+        for tournament_id in tournament_ids:
+            self.persistent_state['tournament_state'][tournament_id][key] = round_number
+
+        if key == 'last_round_trained':
+            self.persistent_state[key] = self.get_last_round_trained()
+
+    def _init_tournament_state(self):
+        """
+        Add state entries for all processed tournaments. If the persistent
+        state is from a version without per-tournament state, all tournaments
+        start from the global entries, as they were processed together.
+        """
+
+        state = self.persistent_state.setdefault('tournament_state', {})
+        migrate = not state
+
+        for tournament_id in self.get_processed_tournament_ids():
+            if tournament_id not in state:
+                state[tournament_id] = {
+                    'last_round_processed': self.persistent_state['last_round_processed'] if migrate else None,
+                    'last_round_trained': self.persistent_state['last_round_trained'] if migrate else None}
+
+    def _get_pending_tournament_ids(self, round_number):
+        """
+        Get the ids of the tournaments that have not yet been processed in a
+        given round, or that have never been trained.
+        """
+
+        state = self.persistent_state['tournament_state']
+        return [x for x in self.get_processed_tournament_ids()
+                if state[x]['last_round_processed'] is None or
+                state[x]['last_round_processed'] < round_number or
+                state[x]['last_round_trained'] is None]
+
+    def _dispatch_event(self, event, *args, tournament_ids=None):
+        """
+        Call an event on all event handlers. Handlers are called in order, or
+        in parallel if the 'handler_workers' configuration entry is larger
+        than 1.
+
+        Args:
+            event: Name of the event handler method to call, e.g. 'on_start'
+            args: Arguments for the event handler method.
+            tournament_ids: Ids of the tournaments the event applies to. Event
+                            handlers with a tournament_id attribute that is
+                            not in this list are skipped (default: None, i.e.
+                            all event handlers)
+        """
+
+        handlers = self._get_sorted_event_handlers()
+        if tournament_ids is not None:
+            handlers = [h for h in handlers if getattr(h, 'tournament_id', None) is None or
+                        h.tournament_id in tournament_ids]
+
+        if self.config['handler_workers'] <= 1 or len(handlers) <= 1:
+            for h in handlers:
+                self._call_event_handler(h, event, args)
+        else:
+            self._dispatch_event_parallel(handlers, event, args)
+
+    def _call_event_handler(self, handler, event, args):
+        """
+        Call an event on one event handler, and add the duration and outcome
+        of the call to the history in the state store.
+        """
+
+        start_time = time.time()
+        error = None
+        measurement = Measurement()
+        try:
+            with measurement:
+                if self.config['profile'] and self._is_profiled(handler, event):
+                    self._call_event_handler_profiled(handler, event, args)
+                else:
+                    getattr(handler, event)(*args)
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            if self.report is not None:
+                self.report['timings']['handlers'][handler.name][event] = measurement.to_dict()
+
+            with self._history_lock:
+                self._history['handler_events'].append({
+                    'round_number': self.round_number,
+                    'handler': handler.name,
+                    'event': event,
+                    'start_time': start_time,
+                    'wall_time': measurement.wall_time,
+                    'error': error})
+
+    def _is_profiled(self, handler, event):
+        """ Check whether an event of an event handler matches the 'profile' configuration entry """
+
+        name = '{}.{}'.format(handler.name, event)
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in self.config['profile'])
+
+    def _call_event_handler_profiled(self, handler, event, args):
+        """
+        Call an event on one event handler with a profiler, and write the
+        profile to the report directory. The filename of the profile is added
+        to report['profiles'].
+        """
+
+        profiler = create_profiler(self.config['profiler'], self.config['profile_interval'])
+        try:
+            profiler.start()
+        except ValueError as e:
+            logger.warning('Not profiling %s of event handler %s: %s', event, handler.name, e)
+            getattr(handler, event)(*args)
+            return
+
+        try:
+            getattr(handler, event)(*args)
+        finally:
+            profiler.stop()
+
+            report_directory = Path(self.config.get('report_directory', './reports'))
+            report_directory.mkdir(parents=True, exist_ok=True)
+            prefix = 'round_{}_'.format(self.round_number) if self.round_number is not None else ''
+            filename = report_directory / '{}{}_{}{}'.format(prefix, handler.name, event, profiler.extension)
+            profiler.dump_stats(filename)
+
+            logger.info('Profile of %s of event handler %s written to %s', event, handler.name, filename)
+            if self.report is not None:
+                self.report['profiles'][handler.name][event] = str(filename)
+
+    @contextlib.contextmanager
+    def _measure_phase(self, phase):
+        """
+        Context manager that adds the wall time of a processing phase (e.g.
+        'download') to report['timings']['phases']. Phases before the start of
+        round processing are added to the report once it is created.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings = self._report['timings']['phases'] if self._report is not None else self._phase_timings
+            timings[phase] = round(timings.get(phase, 0) + time.perf_counter() - start, 3)
+
+    def _run_event_handler(self, handler, event, args, report):
+        """
+        Call an event on one event handler from a worker thread, using a
+        private copy of the round report.
+
+        Returns:
+            Tuple of the private report and the exception raised by the event
+            handler (None if the handler succeeded).
+        """
+
+        self._handler_context.report = report
+        try:
+            self._call_event_handler(handler, event, args)
+            return report, None
+        except Exception as e:
+            logger.exception('Event handler %s raised an exception in %s', handler.name, event)
+            return report, e
+        finally:
+            self._handler_context.report = None
+
+    def _dispatch_event_parallel(self, handlers, event, args):
+        """
+        Call an event on event handlers in a thread pool. A handler is started
+        once all handlers it depends on have finished. The changes each
+        handler makes to the report are merged into the round report in
+        handler order, and if any handler fails, the exception of the first
+        failing handler is raised after all handlers have finished.
+        """
+
+        logger.debug('dispatch_event_parallel(%s): %d handlers, %d workers',
+                     event, len(handlers), self.config['handler_workers'])
+
+        # Index of the last handler each handler depends on (-1 if none)
+        last_dependency = [max([j for j in range(i) if handlers[j].name in h.dependencies], default=-1)
+                           for i, h in enumerate(handlers)]
+
+        results = [None] * len(handlers)
+        snapshots = [None] * len(handlers)
+        started = [False] * len(handlers)
+        failed = set()
+        running = {}
+        next_merge = 0
+
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.config['handler_workers'])
+        try:
+            while next_merge < len(handlers):
+                # Start all handlers of which the dependencies have been merged
+                for i, h in enumerate(handlers):
+                    if started[i] or last_dependency[i] >= next_merge:
+                        continue
+
+                    started[i] = True
+                    if any(d in failed for d in h.dependencies):
+                        logger.error('Skipping %s of event handler %s because a dependency failed',
+                                     event, h.name)
+                        failed.add(h.name)
+                        results[i] = (None, None)
+                        continue
+
+                    report = None
+                    if self._report is not None:
+                        snapshots[i] = copy.deepcopy(self._report)
+                        report = copy.deepcopy(snapshots[i])
+                    running[pool.submit(self._run_event_handler, h, event, args, report)] = i
+
+                # Merge the results of finished handlers in handler order
+                if results[next_merge] is not None:
+                    report, exception = results[next_merge]
+                    if exception is not None:
+                        failed.add(handlers[next_merge].name)
+                        if self._report is not None:
+                            self._report['handler_errors'][event][handlers[next_merge].name] = repr(exception)
+                    elif report is not None:
+                        merge_report(self._report, report, snapshots[next_merge])
+
+                    snapshots[next_merge] = None
+                    next_merge += 1
+                    continue
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        finally:
+            for future in running:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+        for report, exception in results:
+            if exception is not None:
+                raise exception
+
     def _on_start(self):
         """ Internal event on daemon start """
 
         logger.debug('on_start')
-        for h in self.event_handlers:
-            h.on_start()
+        self._dispatch_event('on_start')
 
     def _on_shutdown(self):
         """ Internal event on daemon shutdown """
 
         logger.debug('on_shutdown')
-        for h in self.event_handlers:
-            h.on_shutdown()
+        self._dispatch_event('on_shutdown')
+
+        with self._background_lock:
+            if self._background_executor is not None:
+                self._background_executor.shutdown(wait=False)
+                self._background_executor = None
 
-    def _on_round_begin(self, round_number):
+    def _on_round_begin(self, round_number, tournament_ids=None):
         """ Internal event on round start """
 
         logger.debug('on_round_begin(%d)', round_number)
-        for h in self.event_handlers:
-            h.on_round_begin(round_number)
+        self._dispatch_event('on_round_begin', round_number, tournament_ids=tournament_ids)
 
-    def _on_new_training_data(self, round_number):
+    def _on_new_training_data(self, round_number, tournament_ids=None):
         """ Internal event on detection of new training data """
 
         logger.debug('on_new_training_data(%d)', round_number)
-        for h in self.event_handlers:
-            h.on_new_training_data(round_number)
+        self._dispatch_event('on_new_training_data', round_number, tournament_ids=tournament_ids)
 
-    def _on_new_tournament_data(self, round_number):
+    def _on_new_tournament_data(self, round_number, tournament_ids=None):
         """ Internal event on detection of new tournament data """
 
         logger.debug('on_new_tournament_data(%d)', round_number)
-        for h in self.event_handlers:
-            h.on_new_tournament_data(round_number)
+        self._dispatch_event('on_new_tournament_data', round_number, tournament_ids=tournament_ids)
 
-    def _on_cleanup(self, round_number):
+    def _on_cleanup(self, round_number, tournament_ids=None):
         """ Internal event on end of round processing """
 
         logger.debug('on_cleanup(%d)', round_number)
-        for h in self.event_handlers:
-            h.on_cleanup(round_number)
+        self.wait_for_background_tasks(self.config['background_task_timeout'])
+        self._dispatch_event('on_cleanup', round_number, tournament_ids=tournament_ids)
 
-    def _check_new_training_data(self, round_number):
+    def _check_new_training_data(self, round_number, last_round_trained):
         """
         Internal function to check if the newly downloaded dataset contains
-        new training data.
+        new training data compared to the dataset of the last round trained.
         """
 
         logger.debug('check_new_training_data(%d)', round_number)
-        if self.persistent_state['last_round_trained'] is None:
+        if last_round_trained is None:
             logger.info('check_new_training_data: last_round_trained not set, '
                         'treating training data as new')
             return True
 
+        # Check the training data first, so that its changes are also
+        # reported if the validation data has changed
+        filename_old = self.get_dataset_path(last_round_trained) / 'numerai_training_data.csv'
+        filename_new = self.get_dataset_path(round_number) / 'numerai_training_data.csv'
+
+        training_changed = check_dataset(filename_old, filename_new, method=self.config['check_dataset_method'])
+        if training_changed:
+            # Report which eras of the training data were added, removed or changed
+            changes = get_dataset_changes(filename_old, filename_new)
+            if changes is not None:
+                self.report['training_data_changes']['since_round_{}'.format(last_round_trained)] = changes
+
         # Check if validation data has changed
         if self.config['check_validation_data']:
-            filename_old = self.get_dataset_path(self.persistent_state['last_round_trained']) / 'numerai_tournament_data.csv'
+            filename_old = self.get_dataset_path(last_round_trained) / 'numerai_tournament_data.csv'
             filename_new = self.get_dataset_path(round_number) / 'numerai_tournament_data.csv'
     
-            if check_dataset(filename_old, filename_new, data_type='validation'):
+            if check_dataset(filename_old, filename_new, data_type='validation',
+                             method=self.config['check_dataset_method']):
                 return True
 
-        filename_old = self.get_dataset_path(self.persistent_state['last_round_trained']) / 'numerai_training_data.csv'
-        filename_new = self.get_dataset_path(round_number) / 'numerai_training_data.csv'
-
-        return check_dataset(filename_old, filename_new)
+        return training_changed
 
     def _get_tournaments (self):
         tournaments = self.napi.get_tournaments()
         self.tournaments = {x['tournament']: x['name'] for x in tournaments}
 
-    def _on_round_begin_internal(self, round_number):
-        """ Internal event on round start """
+    def _get_current_round_details(self):
+        """
+        Request the details of the current round, and update the tournament
+        dictionary from the same query.
+
+        Returns:
+            Dictionary containing round details.
+        """
+
+        round_info, tournaments = self.napi.get_current_round_and_tournaments(tournament=self.tournament_id)
+        self.tournaments = {x['tournament']: x['name'] for x in tournaments}
+        return round_info
+
+    def _on_round_begin_internal(self, round_number, tournament_ids):
+        """ Internal event on round start for the given tournaments """
 
         logger.debug('on_round_begin_internal(%d)', round_number)
         
-        # Update the ID to tournament name dictionary, do this every round
-        # in case of renaming of tournaments
-        self._get_tournaments()
+        # The ID to tournament name dictionary is updated with every round
+        # query, in case of renaming of tournaments
+        if self.tournaments is None:
+            self._get_tournaments()
         
         # Initialize round report dictionary
         self.report = nested_defaultdict()
         self.report['round'] = round_number
+        self.report['tournaments'] = [self.tournaments.get(x, x) for x in tournament_ids]
         self.report['round_processing_start_time'] = datetime.datetime.now()
-        
-        self._on_round_begin(round_number)
+        self.report['timings']['phases'].update(self._phase_timings)
+        self._phase_timings = {}
 
-        # Check if training is needed, if so call on_new_training_data
-        if self._check_new_training_data(round_number):
-            # Signal new training data
-            self._on_new_training_data(round_number)
-            self.persistent_state['last_round_trained'] = round_number
-
-            # Immediately save state to prevent retraining if other event handlers fail
-            self.save_state()
-
-        # Signal new tournament data
-        self._on_new_tournament_data(round_number)
+        # Initialize round prediction registry
+        self.predictions = PredictionRegistry(self.submit_background_task,
+                                              self.config['write_prediction_files'])
+        
+        try:
+            self._on_round_begin(round_number, tournament_ids)
+
+            # Check for each tournament if training is needed. Tournaments that
+            # were last trained in the same round share the result of the check.
+            checks = {}
+            training_ids = []
+            for tournament_id in tournament_ids:
+                last_round_trained = self.get_last_round_trained(tournament_id)
+                if last_round_trained not in checks:
+                    with self._measure_phase('check_training_data'):
+                        checks[last_round_trained] = self._check_new_training_data(round_number, last_round_trained)
+                if checks[last_round_trained]:
+                    training_ids.append(tournament_id)
+
+            # If training is needed, call on_new_training_data
+            if training_ids:
+                # Signal new training data
+                self._on_new_training_data(round_number, training_ids)
+
+                # Wait for background tasks such as writing models, so that the
+                # round is only marked as trained if all of them succeeded
+                failed = self.wait_for_background_tasks(self.config['background_task_timeout'])
+                if failed:
+                    raise RuntimeError('Background tasks failed after training: {}'.format(', '.join(failed)))
+                self._set_tournament_state(training_ids, 'last_round_trained', round_number)
+
+                # Immediately save state to prevent retraining if other event handlers fail
+                self.save_state()
+
+            # Signal new tournament data
+            self._on_new_tournament_data(round_number, tournament_ids)
         
-        self.report['round_processing_end_time'] = datetime.datetime.now()
+            self.report['round_processing_end_time'] = datetime.datetime.now()
         
-        # Signal end of round
-        self._on_cleanup(round_number)
+            # Signal end of round
+            self._on_cleanup(round_number, tournament_ids)
         
+        except Exception as e:
+            # Wait for the background tasks of the failed round, so that their
+            # callbacks write to the report of this round instead of the next
+            try:
+                self.wait_for_background_tasks(self.config['background_task_timeout'])
+            except Exception:
+                logger.exception('Background task callback failed')
+
+            # Save the history of the failed round before passing on the exception
+            self._add_round_history(round_number, tournament_ids, repr(e))
+            self.save_state()
+            raise
+
+        self._add_round_history(round_number, tournament_ids)
+
         print(self.report)
         
-        # Reset report dictionary
+        # Reset report dictionary and prediction registry
         self.report = None
+        self.predictions = None
+
 
+    def _add_round_history(self, round_number, tournament_ids, error=None):
+        """ Add the report of the current round to the history in the state store """
 
-    def wait_till_next_round(self):
+        with self._history_lock:
+            self._history['rounds'].append({
+                'round_number': round_number,
+                'tournament_ids': list(tournament_ids),
+                'start_time': self.report.get('round_processing_start_time'),
+                'end_time': self.report.get('round_processing_end_time'),
+                'error': error,
+                'report': copy.deepcopy(self.report)})
+
+    def wait_till_next_round(self, round_info=None):
         """
-        Wait until a new Numerai round is detected. Will wait until 5 minutes
-        before the closing time of the current round, as reported by the
-        Numerai API. Then the current round number is requested every minute
-        until a new round number is received.
+        Wait until a new Numerai round is detected. Will wait until
+        'wakeup_time' seconds before the closing time of the current round, as
+        reported by the Numerai API. Then the current round is requested with
+        an interval that shrinks as the closing time approaches. If the round
+        is delayed beyond its closing time, the interval grows again with
+        random jitter until a new round number is received.
+
+        Args:
+            round_info: Details of the current round, if already requested
+                        (default: None)
 
         Returns:
             Dictionary with the new round information.
@@ -252,7 +908,8 @@ class Numerauto:
 
         logger.debug('wait_till_next_round')
 
-        round_info = self.napi.get_current_round_details(tournament=self.tournament_id)
+        if round_info is None:
+            round_info = self._get_current_round_details()
         dt_round_close = dateutil.parser.parse(round_info['closeTime'])
         dt_round_close_atstart = dt_round_close
 
@@ -263,6 +920,9 @@ class Numerauto:
                     self.persistent_state['last_round_processed'] + 1,
                     (dt_round_close - dt_now).total_seconds() / 3600)
 
+        # Number of checks since the round close time passed
+        delayed_checks = 0
+
         # Loop until the API reports a new round number
         while new_round_info['number'] == round_info['number']:
             dt_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
@@ -276,16 +936,26 @@ class Numerauto:
                             (dt_round_close - dt_round_close_atstart).total_seconds() / 60)
                 dt_round_close_atstart = dt_round_close
             
-            seconds_wait = (dt_round_close - dt_now).total_seconds() + 5
+            seconds_wait = (dt_round_close - dt_now).total_seconds()
 
             if seconds_wait > self.config['wakeup_time']:
                 # Wait till 'wakeup_time' seconds before round start
-                wait_until(dt_round_close - datetime.timedelta(seconds=self.config['wakeup_time'] - 5))
+                wait_until(dt_round_close - datetime.timedelta(seconds=self.config['wakeup_time']))
+            elif seconds_wait > 0:
+                # Then query round information with a shrinking interval, and
+                # exactly at the round close time
+                delayed_checks = 0
+                wait(min(max(seconds_wait / 2, self.config['round_wait_min_interval']),
+                         self.config['round_wait_interval'], seconds_wait))
             else:
-                # Then query round information every 'round_wait_interval' seconds until round has started
-                wait(min(seconds_wait, self.config['round_wait_interval']))
-
-            new_round_info = self.napi.get_current_round_details(tournament=self.tournament_id)
+                # Round is delayed, back off with jitter
+                interval = min(self.config['round_wait_min_interval'] * 2 ** delayed_checks,
+                               self.config['round_wait_interval'])
+                jitter = self.config['round_wait_jitter']
+                wait(interval * random.uniform(1 - jitter, 1 + jitter))
+                delayed_checks += 1
+
+            new_round_info = self._get_current_round_details()
             dt_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
             logger.info('Periodic check before planned round start. Current '
                         'round: %d. Time to next round: %.1f minutes',
@@ -309,6 +979,154 @@ class Numerauto:
         return self.config['data_directory'] / 'numerai_dataset_{}'.format(round_number)
 
 
+    def load_dataset(self, round_number, filename, columns=None, feature_dtype=None):
+        """
+        Load a data file from the dataset of a given round. Uses the columnar
+        dataset cache if it is available, so that each data file only has to
+        be parsed once per round. The data is loaded with a compact schema
+        (see numerauto.datasets.get_dataset_schema).
+
+        Args:
+            round_number: Number of the round for which the data is requested.
+            filename: Name of the data file, e.g. 'numerai_training_data.csv'.
+            columns: List of columns to load (default: None, i.e. all columns)
+            feature_dtype: dtype of the feature columns (default: None, i.e.
+                           the 'feature_dtype' configuration entry)
+
+        Returns:
+            pandas DataFrame containing the data.
+        """
+
+        if feature_dtype is None:
+            feature_dtype = self.config['feature_dtype']
+
+        return datasets.load_dataset(self.get_dataset_path(round_number) / filename,
+                                     columns=columns, feature_dtype=feature_dtype)
+
+
+    def get_required_dataset_files(self):
+        """
+        Get the data files of the dataset that are required by the event
+        handlers, see EventHandler.dataset_files. The training and tournament
+        data are always required, as they are used to check for new data.
+
+        Returns:
+            Set of required filenames, or None if all files are required.
+        """
+
+        required = {'numerai_training_data.csv', 'numerai_tournament_data.csv'}
+        for handler in self.event_handlers:
+            if handler.dataset_files is None:
+                return None
+            required.update(handler.dataset_files)
+
+        return required
+
+
+    def _extract_dataset(self, zip_filename, members=None):
+        """
+        Extract the dataset of the current round from its archive. Files are
+        extracted by their filename without the directories inside the
+        archive, as they are looked up by filename (like ZipMember does). A
+        new dataset is extracted into a temporary directory that is renamed
+        when done, so that an interrupted extraction is not mistaken for a
+        dataset. If the dataset directory already exists, only the files
+        that are missing are extracted, each through a temporary file.
+
+        Args:
+            zip_filename: Filename of the dataset archive.
+            members: Set of filenames to extract (default: None, i.e. all)
+        """
+
+        path = self.get_dataset_path(self.round_number)
+
+        with zipfile.ZipFile(zip_filename, 'r') as z:
+            # Archive member by filename, the first one if a name occurs twice
+            names = {}
+            for name in z.namelist():
+                filename = os.path.basename(name)
+                if filename and (members is None or filename in members):
+                    names.setdefault(filename, name)
+
+            exists = os.path.isdir(path)
+            if exists:
+                names = {k: v for k, v in names.items() if not os.path.isfile(path / k)}
+                if not names:
+                    return
+                target_path = path
+            else:
+                target_path = path.with_name(path.name + '.tmp')
+                if os.path.isdir(target_path):
+                    shutil.rmtree(target_path)
+                target_path.mkdir(parents=True)
+
+            logger.info('Unzipping %s', ', '.join(sorted(names)))
+            for filename, name in names.items():
+                tmp_filename = target_path / (filename + '.tmp')
+                with z.open(name, 'r') as src, open(tmp_filename, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                os.replace(tmp_filename, target_path / filename)
+
+        if not exists:
+            os.replace(target_path, path)
+
+
+    def get_dataset_changes(self, round_old, round_new, filename):
+        """
+        Get the eras that were added, removed or changed in a data file
+        between the datasets of two rounds (see utils.get_dataset_changes).
+
+        Args:
+            round_old: Number of the old round.
+            round_new: Number of the new round.
+            filename: Name of the data file, e.g. 'numerai_training_data.csv'.
+
+        Returns:
+            Dictionary with lists of the 'added', 'removed' and 'changed'
+            eras, or None if the data files can not be compared by era.
+        """
+
+        return get_dataset_changes(self.get_dataset_path(round_old) / filename,
+                                   self.get_dataset_path(round_new) / filename)
+
+
+    def _download_dataset(self):
+        """
+        Download the dataset archive of the current round, unless it is
+        already available. The download is skipped if the server reports that
+        the archive has not changed since the previous round.
+
+        Returns:
+            pathlib Path of the dataset archive, or None if the archive has
+            not changed since the previous round.
+        """
+
+        zip_filename = self.get_dataset_path(self.round_number).with_suffix('.zip')
+
+        if not os.path.isfile(zip_filename):
+            url = self.napi.get_dataset_url(tournament=self.tournament_id)
+            remote_info = get_remote_info(self.session, url, timeout=self.config['napi_timeout'])
+
+            # Compare with the archive of the previous round, which may have
+            # been downloaded before download information was stored
+            previous_zip_filename = self.get_dataset_path(self.round_number - 1).with_suffix('.zip')
+            previous_info = read_download_info(previous_zip_filename)
+            if previous_info is None and os.path.isfile(previous_zip_filename):
+                previous_info = compute_file_info(previous_zip_filename)
+                write_download_info(previous_zip_filename, previous_info)
+
+            if is_same_file(remote_info, previous_info):
+                logger.info('Dataset archive has not changed since round %d', self.round_number - 1)
+                return None
+
+            self.config['data_directory'].mkdir(parents=True, exist_ok=True)
+            download_file(self.session, url, zip_filename, remote_info=remote_info,
+                          timeout=self.config['napi_timeout'],
+                          connections=self.config['download_connections'])
+
+        return zip_filename
+
+
     def _download_and_check(self):
         """
         Download a new dataset and check whether it contains new tournament
@@ -321,20 +1139,57 @@ class Numerauto:
         logger.debug('download_and_check')
         try:
             logger.info('Downloading dataset')
-            dataset_path = self.napi.download_current_dataset(dest_path=self.config['data_directory'],
-                                                                   unzip=True,
-                                                                   tournament=self.tournament_id)
+            with self._measure_phase('download'):
+                zip_filename = self._download_dataset()
+            if zip_filename is None:
+                return False
 
             filename_old = self.get_dataset_path(self.round_number - 1) / 'numerai_tournament_data.csv'
             filename_new = self.get_dataset_path(self.round_number) / 'numerai_tournament_data.csv'
-
-            valid = check_dataset(filename_old, filename_new, data_type='live')
+            filename_training = self.get_dataset_path(self.round_number) / 'numerai_training_data.csv'
+            selective = self.config['selective_extraction'] and \
+                not os.path.isdir(self.get_dataset_path(self.round_number))
+
+            if selective:
+                # Check the live data in the archive before extracting anything
+                with self._measure_phase('check_dataset'):
+                    valid = check_dataset(filename_old,
+                                          datasets.ZipMember(zip_filename, 'numerai_tournament_data.csv'),
+                                          data_type='live', method=self.config['check_dataset_method'])
+                if valid:
+                    with self._measure_phase('unzip'):
+                        self._extract_dataset(zip_filename, self.get_required_dataset_files())
+            else:
+                # Extract files that are missing from an existing dataset,
+                # e.g. files required by a newly added event handler
+                members = self.get_required_dataset_files() if self.config['selective_extraction'] else None
+                with self._measure_phase('unzip'):
+                    self._extract_dataset(zip_filename, members)
+
+            if self.config['dataset_cache'] and os.path.isfile(filename_new):
+                with self._measure_phase('convert_dataset'):
+                    datasets.convert_dataset(filename_new)
+
+            if not selective:
+                with self._measure_phase('check_dataset'):
+                    valid = check_dataset(filename_old, filename_new, data_type='live',
+                                          method=self.config['check_dataset_method'])
+
+            if valid and self.config['dataset_cache'] and os.path.isfile(filename_training):
+                with self._measure_phase('convert_dataset'):
+                    datasets.convert_dataset(filename_training)
+
+            if valid and self.config['dataset_store']:
+                with self._measure_phase('dataset_store'):
+                    self.dataset_store.add_directory(self.get_dataset_path(self.round_number))
             
             if not valid:
                 # Remove downloaded and unzipped files if dataset not new
-                os.remove(dataset_path)
-                if os.path.isdir(dataset_path[:-4]):
-                    shutil.rmtree(dataset_path[:-4])
+                os.remove(zip_filename)
+                if os.path.isfile(get_info_filename(zip_filename)):
+                    os.remove(get_info_filename(zip_filename))
+                if os.path.isdir(self.get_dataset_path(self.round_number)):
+                    shutil.rmtree(self.get_dataset_path(self.round_number))
                     
         except requests.RequestException:
             import traceback
@@ -364,29 +1219,87 @@ class Numerauto:
             wait(self.config['invalid_dataset_waittime'])
             valid = self._download_and_check()
 
-        # Call round begin event
-        self._on_round_begin_internal(self.round_number)
+        # Call round begin event for the tournaments that were not processed
+        # yet, which are all tournaments unless a tournament was added
+        tournament_ids = self._get_pending_tournament_ids(self.round_number)
+        self._on_round_begin_internal(self.round_number, tournament_ids)
 
         # Save current round as the last round processed
+        self._set_tournament_state(tournament_ids, 'last_round_processed', self.round_number)
         self.persistent_state['last_round_processed'] = self.round_number
 
         # Save persistent state (in case of any crash)
         self.save_state()
 
+        self._apply_dataset_retention()
+
+
+    def _apply_dataset_retention(self):
+        """
+        Remove the datasets of the oldest rounds until the data directory fits
+        in the 'dataset_disk_budget' configuration entry. The dataset of the
+        current round and the datasets of the rounds last trained on are kept,
+        as they are used to check for new data.
+        """
+
+        budget = self.config['dataset_disk_budget']
+        data_directory = self.config['data_directory']
+        if budget is None or not os.path.isdir(data_directory):
+            return
+
+        protected = {self.round_number, self.persistent_state.get('last_round_trained')}
+        protected.update(state.get('last_round_trained')
+                         for state in self.persistent_state.get('tournament_state', {}).values())
+
+        # Dataset directories, archives and download information by round
+        rounds = collections.defaultdict(list)
+        for name in os.listdir(data_directory):
+            match = re.fullmatch(r'numerai_dataset_(\d+)(\..*)?', name)
+            if match:
+                rounds[int(match.group(1))].append(data_directory / name)
+
+        usage = get_disk_usage(data_directory)
+        for round_number in sorted(rounds):
+            if usage <= budget:
+                break
+            if round_number in protected:
+                continue
+
+            logger.info('Removing dataset of round %d (data directory uses %.1f MB, budget %.1f MB)',
+                        round_number, usage / 2**20, budget / 2**20)
+            for path in rounds[round_number]:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            self.dataset_store.collect_garbage()
+            usage = get_disk_usage(data_directory)
+
+        if usage > budget:
+            logger.warning('Data directory uses %.1f MB, which exceeds the budget of %.1f MB',
+                           usage / 2**20, budget / 2**20)
+
 
     def load_state(self):
-        """ Load the internal state from file using pickle. """
+        """
+        Load the internal state from the state store. The state.pickle file of
+        older versions is migrated to the state store if the store is empty.
+        """
 
         logger.debug('load_state')
 
-        # Try loading the state from file
-        try:
-            with open('state.pickle', 'rb') as fp:
-                self.persistent_state = pickle.load(fp)
-        except FileNotFoundError:
-            self.persistent_state = {}
-        except EOFError:
-            self.persistent_state = {}
+        if self.state_store is None:
+            self.state_store = StateStore(self.config['state_filename'])
+
+        if self.state_store.is_empty() and os.path.isfile('state.pickle'):
+            logger.info('load_state: Migrating state.pickle to %s', self.config['state_filename'])
+            try:
+                with open('state.pickle', 'rb') as fp:
+                    self.persistent_state = pickle.load(fp)
+            except EOFError:
+                self.persistent_state = {}
+        else:
+            self.persistent_state = self.state_store.load()
 
         # Set last round processed and trained if it does not exist
         if 'last_round_processed' not in self.persistent_state:
@@ -402,7 +1315,10 @@ class Numerauto:
 
 
     def save_state(self):
-        """ Save the internal state to file using pickle. """
+        """
+        Save the internal state and the round history that has not been saved
+        yet to the state store, in a single transaction.
+        """
 
         logger.debug('save_state')
         logger.debug('save_state: last_round_processed = %s',
@@ -410,8 +1326,19 @@ class Numerauto:
         logger.debug('save_state: last_round_trained = %s',
                      self.persistent_state['last_round_trained'])
 
-        with open('state.pickle', 'wb') as fp:
-            pickle.dump(self.persistent_state, fp)
+        with self._history_lock:
+            rounds = self._history['rounds']
+            handler_events = self._history['handler_events']
+            self._history = {'rounds': [], 'handler_events': []}
+
+        try:
+            self.state_store.save(self.persistent_state, rounds, handler_events)
+        except Exception:
+            # Keep the history to save it with the next state
+            with self._history_lock:
+                self._history['rounds'][:0] = rounds
+                self._history['handler_events'][:0] = handler_events
+            raise
 
 
     # Run Numerauto in daemon mode
@@ -432,6 +1359,7 @@ class Numerauto:
         # Set up signal handlers to gracefully exit
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
+        get_scheduler().reset()
 
         # Load internal state
         self.load_state()
@@ -439,11 +1367,16 @@ class Numerauto:
         # Trigger start event
         self._on_start()
 
+        # Add state for new tournaments, after the event handlers have set
+        # their tournament ids
+        self._init_tournament_state()
+
         try:
-            self.round_number = self.napi.get_current_round(tournament=self.tournament_id)
+            round_info = self._get_current_round_details()
+            self.round_number = round_info['number']
             if (self.persistent_state['last_round_processed'] is None or
-                    self.persistent_state['last_round_trained'] is None or
-                    self.round_number > self.persistent_state['last_round_processed']):
+                    self.round_number > self.persistent_state['last_round_processed'] or
+                    self._get_pending_tournament_ids(self.round_number)):
                 logger.info('Current round (%d) does not appear to be processed',
                             self.round_number)
                 self._run_new_round()
@@ -451,14 +1384,12 @@ class Numerauto:
             logger.info('Entering daemon loop')
         
             while True:
-                self.round_number = self.napi.get_current_round(tournament=self.tournament_id)
+                round_info = self._get_current_round_details()
                 # Check if we didn't already pass into the next round
-                if self.round_number == self.persistent_state['last_round_processed']:
+                if round_info['number'] == self.persistent_state['last_round_processed']:
                     # In case of a single run, check whether we're not going to wait
                     # too long (> 24 hours) for the next round
                     if single_run:
-                        round_info = self.napi.get_current_round_details(tournament=self.tournament_id)
-    
                         dt_round_close = dateutil.parser.parse(round_info['closeTime'])
                         dt_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
 
@@ -467,7 +1398,7 @@ class Numerauto:
                             break
     
                     # Wait till next round starts
-                    round_info = self.wait_till_next_round()
+                    round_info = self.wait_till_next_round(round_info)
 
                 self.round_number = round_info['number']
                 self._run_new_round()
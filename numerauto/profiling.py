@@ -0,0 +1,126 @@
+"""
+Profilers for Numerauto
+
+Event handler calls can be profiled with the 'profile' configuration entry of
+Numerauto. Two profilers are available:
+
+- 'cprofile': the deterministic cProfile profiler, which records every
+  function call of the profiled thread. The profile is written in the pstats
+  format (.prof), which can be inspected with the pstats module or tools such
+  as snakeviz.
+- 'sampling': a profiler that samples the stack of the profiled thread at a
+  fixed interval from a separate thread. It has a low overhead that does not
+  depend on the number of function calls, and writes the number of samples
+  per stack in the folded stacks format (.txt) used by flame graph tools.
+"""
+
+import os
+import sys
+import cProfile
+import logging
+import threading
+import collections
+
+
+logger = logging.getLogger(__name__)
+
+
+class CProfileProfiler:
+    """ Profiler that uses cProfile for the calling thread """
+
+    extension = '.prof'
+
+    def __init__(self, interval=None):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        """
+        Start profiling the calling thread.
+
+        Raises:
+            ValueError: If another profiler is active (Python 3.12 and later)
+        """
+
+        self._profile.enable()
+
+    def stop(self):
+        """ Stop profiling """
+        self._profile.disable()
+
+    def dump_stats(self, filename):
+        """ Write the profile in pstats format """
+        self._profile.dump_stats(filename)
+
+
+class SamplingProfiler:
+    """
+    Profiler that samples the stack of the calling thread from a separate
+    thread.
+
+    Attributes:
+        interval: Number of seconds between samples.
+    """
+
+    extension = '.txt'
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _run(self, thread_id):
+        """ Sampling thread """
+
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self._stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        """ Start profiling the calling thread """
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(threading.get_ident(),),
+                                        name='numerauto-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop profiling """
+
+        self._stopped.set()
+        self._thread.join()
+
+    def dump_stats(self, filename):
+        """ Write the number of samples per stack in folded stacks format """
+
+        with open(filename, 'w') as fp:
+            for stack, count in self._stacks.most_common():
+                fp.write('{} {}\n'.format(stack, count))
+
+
+PROFILERS = {'cprofile': CProfileProfiler,
+             'sampling': SamplingProfiler}
+
+
+def create_profiler(name, interval=0.005):
+    """
+    Create a profiler.
+
+    Args:
+        name: Name of the profiler: 'cprofile' or 'sampling'.
+        interval: Number of seconds between samples of the sampling profiler.
+
+    Returns:
+        Profiler with start, stop and dump_stats methods.
+    """
+
+    if name not in PROFILERS:
+        raise ValueError('Unknown profiler {}, expected one of {}'.format(name, ', '.join(PROFILERS)))
+
+    return PROFILERS[name](interval)
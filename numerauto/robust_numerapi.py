@@ -3,8 +3,10 @@ Module containing a robust implementation of NumerAPI.
 """
 
 import logging
+import threading
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
 
 import numerapi
@@ -17,6 +19,25 @@ logger = logging.getLogger(__name__)
 API_TOURNAMENT_URL = 'https://api-tournament.numer.ai'
 
 
+def create_session(pool_size=10):
+    """
+    Creates a requests Session with a pool of keep-alive connections, which
+    can be shared by multiple RobustNumerAPI instances.
+
+    Args:
+        pool_size: Maximum number of connections kept alive per host.
+
+    Returns:
+        requests Session instance.
+    """
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 class NumerAPIAuthorizationError(Exception):
     """ Error that is raised if authorization using the Numerai API fails. """
     pass
@@ -38,10 +59,19 @@ class RobustNumerAPI(numerapi.NumerAPI):
     Robust implementation of NumerAPI.
 
     Checks for failure of requests and retries the requests until they succeed.
+    All API queries are sent through a requests Session, so that connections
+    are kept alive between queries. A session can be shared between multiple
+    instances.
+
+    Attributes:
+        session: requests Session used for API queries.
+        timeout: Timeout in seconds for API queries, either a single number or
+                 a (connect timeout, read timeout) tuple. None waits forever.
     """
     
     def __init__(self, public_id=None, secret_key=None, verbosity="INFO",
-                 show_progress_bars=True, retry_wait_schedule=None):
+                 show_progress_bars=True, retry_wait_schedule=None, session=None,
+                 timeout=None):
         super().__init__(public_id=public_id, secret_key=secret_key,
                          verbosity=verbosity, show_progress_bars=show_progress_bars)
         
@@ -49,8 +79,15 @@ class RobustNumerAPI(numerapi.NumerAPI):
         if retry_wait_schedule is None:
             retry_wait_schedule = [60, 60, 60, 60, 60, 600, 600, 600, 3600, 3600, 3600]
         self.retry_wait_schedule = retry_wait_schedule
-        
-        self._raw_query_retry = True
+
+        # If no session is supplied, use a private session
+        if session is None:
+            session = create_session()
+        self.session = session
+        self.timeout = timeout
+
+        # Per-thread state, as a client may be shared between threads
+        self._thread_state = threading.local()
         
         
     def __raw_query_patched(self, query, variables=None, authorization=False):
@@ -70,7 +107,7 @@ class RobustNumerAPI(numerapi.NumerAPI):
                     'Token {}${}'.format(public_id, secret_key)
             else:
                 raise NumerAPIAuthorizationError("API keys required for this action.")
-        r = requests.post(API_TOURNAMENT_URL, json=body, headers=headers)
+        r = self.session.post(API_TOURNAMENT_URL, json=body, headers=headers, timeout=self.timeout)
         
         # Ensure any 4xx and 5xx return codes raise an HTTPError
         r.raise_for_status()
@@ -95,7 +132,7 @@ class RobustNumerAPI(numerapi.NumerAPI):
                 return self.__raw_query_patched(query, variables=variables,
                                                 authorization=authorization)
             except RequestException as e:
-                if self._raw_query_retry:
+                if getattr(self._thread_state, 'raw_query_retry', True):
                     logger.error('Request failed: %s', e)
                     wait_for_retry(attempt_number, self.retry_wait_schedule)
                     attempt_number += 1
@@ -111,7 +148,7 @@ class RobustNumerAPI(numerapi.NumerAPI):
         """
         
         attempt_number = 0
-        self._raw_query_retry = False
+        self._thread_state.raw_query_retry = False
         while True:
             try:
                 return super().upload_predictions(file_path, tournament=tournament)
@@ -120,7 +157,7 @@ class RobustNumerAPI(numerapi.NumerAPI):
                 wait_for_retry(attempt_number, self.retry_wait_schedule)
                 attempt_number += 1
             finally:
-                self._raw_query_retry = True
+                self._thread_state.raw_query_retry = True
 
                 # TODO: See if we need to re-raise some request exceptions
 
@@ -153,3 +190,41 @@ class RobustNumerAPI(numerapi.NumerAPI):
             raise RuntimeError('get_current_round_details returned None')
 
         return raw['data']['rounds'][0]
+
+    def get_current_round_and_tournaments(self, tournament=1):
+        """
+        Requests time details about the current round and the list of active
+        tournaments in a single query.
+
+        Returns:
+            Tuple of a dictionary containing round details (see
+            get_current_round_details) and a list of dictionaries containing
+            the active tournaments (see get_tournaments).
+        """
+        query = '''
+            query($tournament: Int!) {
+              rounds(tournament: $tournament
+                     number: 0) {
+                number
+                openTime
+                closeTime
+                resolveTime
+              }
+              tournaments {
+                id
+                name
+                tournament
+                active
+              }
+            }
+        '''
+        arguments = {'tournament': tournament}
+
+        raw = self.raw_query(query, arguments)
+
+        if raw is None:
+            logger.error('get_current_round_and_tournaments returned None')
+            raise RuntimeError('get_current_round_and_tournaments returned None')
+
+        tournaments = [x for x in raw['data']['tournaments'] if x['active']]
+        return raw['data']['rounds'][0], tournaments
@@ -0,0 +1,185 @@
+"""
+Scheduler for Numerauto
+
+All waiting in Numerauto goes through a single Scheduler, which keeps a heap
+of timers that is processed by one dispatcher thread. A waiting thread blocks
+on a threading.Event until its timer fires, so an idle wait does not wake up
+periodically, and multiple timed activities can run concurrently. Cancelling
+the scheduler (done by the Numerauto signal handler) immediately wakes up all
+waiting threads, which then raise WaitCancelled.
+"""
+
+import os
+import time
+import heapq
+import logging
+import datetime
+import itertools
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+# Maximum number of seconds a wait blocks before checking the clock again.
+# Deadlines are wall-clock times, so the clock is checked regularly to follow
+# clock adjustments. On Windows, waiting on an event can not be interrupted by
+# a signal, so the main thread has to wake up every second to handle ctrl-c.
+WAIT_SLICE = 1 if os.name == 'nt' else 3600
+
+
+class WaitCancelled(Exception):
+    """ Exception that is raised by a wait that is cancelled by Scheduler.cancel. """
+    pass
+
+
+class Timer:
+    """
+    Scheduled function call, returned by Scheduler.call_at and
+    Scheduler.call_later.
+
+    Attributes:
+        deadline: Unix timestamp at which the function is called.
+        function: Function to call.
+        args: Arguments of the function.
+        cancelled: Indicates whether the call was cancelled.
+    """
+
+    def __init__(self, deadline, function, args):
+        self.deadline = deadline
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """ Cancel the call, if it has not been made yet """
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    Timer heap that calls functions at given times from a dispatcher thread,
+    and lets threads wait until a given time.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        # Reentrant, as cancel may be called from a signal handler
+        self._condition = threading.Condition(threading.RLock())
+        self._thread = None
+        self._sleepers = set()
+        self._cancelled = threading.Event()
+
+    def call_at(self, timestamp, function, *args):
+        """
+        Call a function from the dispatcher thread at a given time. The
+        function should return quickly, as it delays all later timers.
+
+        Args:
+            timestamp: Time of the call, as a timezone-aware datetime or a unix
+                       timestamp.
+            function: Function to call.
+            *args: Arguments of the function.
+
+        Returns:
+            Timer that can be used to cancel the call.
+        """
+
+        if isinstance(timestamp, datetime.datetime):
+            timestamp = timestamp.timestamp()
+
+        timer = Timer(timestamp, function, args)
+        with self._condition:
+            heapq.heappush(self._heap, (timer.deadline, next(self._counter), timer))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='numerauto-scheduler', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+        return timer
+
+    def call_later(self, seconds, function, *args):
+        """
+        Call a function from the dispatcher thread after a given number of
+        seconds. See call_at.
+        """
+
+        return self.call_at(time.time() + seconds, function, *args)
+
+    def _run(self):
+        """ Dispatcher thread """
+
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.time():
+                    timeout = min(self._heap[0][0] - time.time(), WAIT_SLICE) if self._heap else None
+                    self._condition.wait(timeout)
+                _, _, timer = heapq.heappop(self._heap)
+
+            if not timer.cancelled:
+                try:
+                    timer.function(*timer.args)
+                except Exception:
+                    logger.exception('Scheduler: Timer function %s failed', timer.function)
+
+    def sleep_until(self, timestamp):
+        """
+        Wait until a given time.
+
+        Args:
+            timestamp: Time to wait until, as a timezone-aware datetime or a
+                       unix timestamp.
+
+        Raises:
+            WaitCancelled: If the scheduler is cancelled.
+        """
+
+        if self._cancelled.is_set():
+            raise WaitCancelled()
+
+        event = threading.Event()
+        with self._condition:
+            self._sleepers.add(event)
+        timer = self.call_at(timestamp, event.set)
+
+        try:
+            while not event.wait(WAIT_SLICE):
+                pass
+        finally:
+            timer.cancel()
+            with self._condition:
+                self._sleepers.discard(event)
+
+        if self._cancelled.is_set():
+            raise WaitCancelled()
+
+    def sleep(self, seconds):
+        """
+        Wait for a given number of seconds. See sleep_until.
+        """
+
+        self.sleep_until(time.time() + seconds)
+
+    def cancel(self):
+        """
+        Wake up all waiting threads and let them raise WaitCancelled. Later
+        waits are cancelled immediately, until reset is called.
+        """
+
+        self._cancelled.set()
+        with self._condition:
+            for event in self._sleepers:
+                event.set()
+
+    def reset(self):
+        """ Allow waiting again after cancel """
+        self._cancelled.clear()
+
+
+_scheduler = Scheduler()
+
+
+def get_scheduler():
+    """ Get the scheduler that is used for all waits in Numerauto """
+    return _scheduler
@@ -0,0 +1,256 @@
+"""
+State store for Numerauto
+
+The persistent state of Numerauto is stored in an SQLite database, so that
+every save is an atomic transaction that survives the daemon being killed
+while writing. Each entry of the persistent state dictionary is stored as a
+separate row, both pickled (to restore it exactly) and as JSON if possible,
+so that other programs can read the state without unpickling it.
+
+The database also keeps the history of all rounds: one row per processed
+round with its round report, and one row per event handler call with its
+duration and outcome. For example, the failed event handler calls of the last
+ten rounds can be listed with:
+
+    sqlite3 state.db "SELECT round_number, handler, event, error FROM handler_events
+                      WHERE error IS NOT NULL ORDER BY id DESC LIMIT 10"
+"""
+
+import json
+import pickle
+import sqlite3
+import logging
+import datetime
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+STATE_STORE_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    json TEXT
+);
+CREATE TABLE IF NOT EXISTS rounds (
+    id INTEGER PRIMARY KEY,
+    round_number INTEGER NOT NULL,
+    tournament_ids TEXT NOT NULL,
+    start_time TEXT,
+    end_time TEXT,
+    error TEXT,
+    report TEXT
+);
+CREATE INDEX IF NOT EXISTS rounds_round_number ON rounds (round_number);
+CREATE TABLE IF NOT EXISTS handler_events (
+    id INTEGER PRIMARY KEY,
+    round_number INTEGER,
+    handler TEXT NOT NULL,
+    event TEXT NOT NULL,
+    start_time TEXT NOT NULL,
+    wall_time REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS handler_events_round_number ON handler_events (round_number);
+"""
+
+
+def _to_json(value):
+    """ Convert a value to JSON (with string keys), or None if it can not be converted """
+
+    try:
+        return json.dumps(value, allow_nan=False)
+    except (TypeError, ValueError):
+        return None
+
+
+def _stringify_keys(value):
+    """ Recursively convert the keys of dictionaries to strings """
+
+    if isinstance(value, dict):
+        return {str(k): _stringify_keys(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_stringify_keys(x) for x in value]
+    return value
+
+
+def _report_to_json(report):
+    """
+    Convert a round report to JSON. Keys are converted to strings and values
+    that can not be converted are stored as strings. If the report still can
+    not be converted, it is stored as a single string.
+    """
+
+    try:
+        return json.dumps(_stringify_keys(report), default=str)
+    except (TypeError, ValueError, RecursionError) as e:
+        logger.warning('Storing the round report as a string, as it can not be converted to JSON: %r', e)
+        return json.dumps(str(report))
+
+
+def _format_time(value):
+    """ Format a datetime or unix timestamp as an ISO 8601 string """
+
+    if value is None or isinstance(value, str):
+        return value
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.fromtimestamp(value)
+    return value.isoformat()
+
+
+class StateStore:
+    """
+    SQLite database that stores the persistent state and the round history
+    of Numerauto.
+
+    Attributes:
+        filename: Filename of the database.
+    """
+
+    def __init__(self, filename):
+        """
+        Opens or creates a state database.
+
+        Args:
+            filename: Filename of the database.
+        """
+
+        self.filename = filename
+        self._lock = threading.Lock()
+        # Pickled state entries as last written, to only write changed entries
+        self._saved = {}
+
+        self._connection = sqlite3.connect(str(filename), check_same_thread=False)
+        # Write-ahead logging: commits are atomic and readers do not block the daemon
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        with self._connection:
+            version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+            if version > STATE_STORE_VERSION:
+                raise ValueError('Unsupported state store version {} in {}'.format(version, filename))
+            self._connection.executescript(_SCHEMA)
+            self._connection.execute('PRAGMA user_version = {:d}'.format(STATE_STORE_VERSION))
+
+    def close(self):
+        """ Close the database """
+
+        with self._lock:
+            self._connection.close()
+
+    def is_empty(self):
+        """ Check whether the database does not contain a state yet """
+
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM state').fetchone()[0] == 0
+
+    def load(self):
+        """
+        Load the persistent state.
+
+        Returns:
+            Dictionary with the persistent state.
+        """
+
+        with self._lock:
+            rows = self._connection.execute('SELECT key, value FROM state').fetchall()
+
+        self._saved = {key: value for key, value in rows}
+        return {key: pickle.loads(value) for key, value in rows}
+
+    def save(self, state, rounds=(), handler_events=()):
+        """
+        Save the persistent state and add round history in a single
+        transaction. Only state entries that have changed are written.
+
+        Args:
+            state: Dictionary with the persistent state. All keys must be strings.
+            rounds: Dictionaries with the round_number, tournament_ids,
+                    start_time, end_time, error and report of processed rounds.
+            handler_events: Dictionaries with the round_number, handler, event,
+                            start_time, wall_time and error of event handler calls.
+        """
+
+        values = {key: pickle.dumps(value) for key, value in state.items()}
+
+        with self._lock, self._connection:
+            for key in self._saved.keys() - values.keys():
+                self._connection.execute('DELETE FROM state WHERE key = ?', (key,))
+            for key, value in values.items():
+                if self._saved.get(key) != value:
+                    self._connection.execute('INSERT OR REPLACE INTO state (key, value, json) VALUES (?, ?, ?)',
+                                             (key, value, _to_json(state[key])))
+
+            self._connection.executemany(
+                'INSERT INTO rounds (round_number, tournament_ids, start_time, end_time, error, report) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(x['round_number'], json.dumps(x['tournament_ids']), _format_time(x.get('start_time')),
+                  _format_time(x.get('end_time')), x.get('error'),
+                  _report_to_json(x['report']) if x.get('report') is not None else None)
+                 for x in rounds])
+
+            self._connection.executemany(
+                'INSERT INTO handler_events (round_number, handler, event, start_time, wall_time, error) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(x['round_number'], x['handler'], x['event'], _format_time(x['start_time']),
+                  x['wall_time'], x.get('error'))
+                 for x in handler_events])
+
+        self._saved = values
+
+    def get_rounds(self, round_number=None):
+        """
+        Get the history of processed rounds.
+
+        Args:
+            round_number: Only get the history of this round (default: None,
+                          i.e. all rounds)
+
+        Returns:
+            List of dictionaries with the round_number, tournament_ids,
+            start_time, end_time, error and report of each processed round,
+            oldest first.
+        """
+
+        query = 'SELECT round_number, tournament_ids, start_time, end_time, error, report FROM rounds'
+        params = ()
+        if round_number is not None:
+            query += ' WHERE round_number = ?'
+            params = (round_number,)
+
+        with self._lock:
+            rows = self._connection.execute(query + ' ORDER BY id', params).fetchall()
+
+        return [{'round_number': row[0],
+                 'tournament_ids': json.loads(row[1]),
+                 'start_time': row[2],
+                 'end_time': row[3],
+                 'error': row[4],
+                 'report': json.loads(row[5]) if row[5] is not None else None}
+                for row in rows]
+
+    def get_handler_events(self, round_number=None):
+        """
+        Get the history of event handler calls.
+
+        Args:
+            round_number: Only get the calls of this round (default: None,
+                          i.e. all rounds)
+
+        Returns:
+            List of dictionaries with the round_number, handler, event,
+            start_time, wall_time and error of each call, oldest first.
+        """
+
+        query = 'SELECT round_number, handler, event, start_time, wall_time, error FROM handler_events'
+        params = ()
+        if round_number is not None:
+            query += ' WHERE round_number = ?'
+            params = (round_number,)
+
+        with self._lock:
+            rows = self._connection.execute(query + ' ORDER BY id', params).fetchall()
+
+        return [dict(zip(['round_number', 'handler', 'event', 'start_time', 'wall_time', 'error'], row))
+                for row in rows]
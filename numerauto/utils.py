@@ -3,33 +3,57 @@ Utilities for Numerauto
 """
 
 import os
-import logging
+import sys
 import time
-import datetime
+import logging
 import dateutil
 
-import pandas
-import pytz
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+import numpy as np
+import pandas as pd
+
+from .datasets import load_dataset, is_cached, get_fingerprints, dataset_exists
+from .datasets import read_dataset_chunks, hash_rows
+from .scheduler import get_scheduler
 
 
 logger = logging.getLogger(__name__)
 
 
-def check_dataset(filename_old, filename_new, data_type=None):
+# Number of rows read at a time by the chunked check_dataset method
+CHECK_DATASET_CHUNKSIZE = 50000
+
+
+def check_dataset(filename_old, filename_new, data_type=None, method='full'):
     """
     Checks whether two Numerai datasets are the same. Optionally it can check
     only rows with a specified data_type.
 
     Args:
         filename_old: Filename of the first (old) dataset
-        filename_new: Filename of the second (new) dataset
+        filename_new: Filename of the second (new) dataset, or a
+                      numerauto.datasets.ZipMember to read the new dataset
+                      directly from its archive
         data_type: Data type of the rows to check (default: None, i.e. all rows)
+        method: 'full' loads both datasets completely and compares them,
+                'fingerprint' compares the row digests of both datasets, which
+                are computed once per dataset and stored next to it,
+                'chunked' streams through the new dataset in chunks and
+                returns as soon as a difference is found.
+
+    Returns:
+        True if the new dataset differs from the old dataset, False otherwise.
     """
 
     logger.debug('check_dataset(%s, %s)', filename_old, filename_new)
 
     # Load dataset from last round and current round (if available)
-    if not os.path.isfile(filename_new):
+    if not dataset_exists(filename_new):
         logger.error('check_dataset: New data could not be loaded')
         return False
 
@@ -37,11 +61,21 @@ def check_dataset(filename_old, filename_new, data_type=None):
         logger.info('check_dataset: No previous dataset available. Skipping check.')
         return True
 
-    logger.info('check_dataset: Checking %s vs %s (data type: %s)', filename_old, filename_new, data_type if data_type is not None else "all")
+    logger.info('check_dataset: Checking %s vs %s (data type: %s, method: %s)', filename_old, filename_new,
+                data_type if data_type is not None else "all", method)
+
+    if method == 'fingerprint':
+        return _check_dataset_fingerprint(filename_old, filename_new, data_type)
+    elif method == 'chunked':
+        if is_cached(filename_old):
+            return _check_dataset_keyed(filename_old, filename_new, data_type)
+        return _check_dataset_aligned(filename_old, filename_new, data_type)
+    elif method != 'full':
+        raise ValueError('Unknown check_dataset method: {}'.format(method))
 
     # Read datasets
-    old_dataset = pandas.read_csv(filename_old)
-    new_dataset = pandas.read_csv(filename_new)
+    old_dataset = load_dataset(filename_old)
+    new_dataset = load_dataset(filename_new)
 
     if data_type is not None:
         # Filter only data_type from datasets
@@ -70,37 +104,259 @@ def check_dataset(filename_old, filename_new, data_type=None):
     return False
 
 
+def get_dataset_changes(filename_old, filename_new):
+    """
+    Determines which eras were added, removed or changed between two Numerai
+    datasets, by comparing the fingerprints of the eras.
+
+    Args:
+        filename_old: Filename of the first (old) dataset
+        filename_new: Filename of the second (new) dataset
+
+    Returns:
+        Dictionary with lists of the 'added', 'removed' and 'changed' eras,
+        or None if the datasets can not be compared by era (a dataset is not
+        available, or the columns changed).
+    """
+
+    if not os.path.isfile(filename_old) or not os.path.isfile(filename_new):
+        return None
+
+    fingerprints_old = get_fingerprints(filename_old)
+    fingerprints_new = get_fingerprints(filename_new)
+
+    if fingerprints_old['columns'] != fingerprints_new['columns']:
+        logger.debug('get_dataset_changes: Columns changed')
+        return None
+
+    eras_old = fingerprints_old['era']
+    eras_new = fingerprints_new['era']
+
+    changes = {'added': [x for x in eras_new if x not in eras_old],
+               'removed': [x for x in eras_old if x not in eras_new],
+               'changed': [x for x in eras_new if x in eras_old and eras_new[x] != eras_old[x]]}
+
+    logger.info('get_dataset_changes: %d eras added, %d removed, %d changed',
+                len(changes['added']), len(changes['removed']), len(changes['changed']))
+    return changes
+
+
+def _check_dataset_fingerprint(filename_old, filename_new, data_type=None):
+    """ Implementation of check_dataset using dataset fingerprints """
+
+    fingerprints_old = get_fingerprints(filename_old)
+    fingerprints_new = get_fingerprints(filename_new)
+
+    if fingerprints_old['columns'] != fingerprints_new['columns']:
+        logger.debug('check_dataset: Columns changed')
+        return True
+
+    if data_type is None:
+        digest_old = fingerprints_old['all']
+        digest_new = fingerprints_new['all']
+    else:
+        digest_old = fingerprints_old['data_type'].get(data_type)
+        digest_new = fingerprints_new['data_type'].get(data_type)
+
+    if digest_old != digest_new:
+        logger.debug('check_dataset: Fingerprint of new dataset does not equal old dataset')
+        return True
+
+    logger.debug('check_dataset: No change detected')
+    return False
+
+
+def _filter_chunks(chunks, data_type):
+    """ Filter dataset chunks on data type, skipping empty chunks """
+
+    for chunk in chunks:
+        if data_type is not None:
+            chunk = chunk[chunk['data_type'] == data_type]
+        if len(chunk) > 0:
+            yield chunk
+
+
+def _check_dataset_keyed(filename_old, filename_new, data_type=None):
+    """
+    Implementation of the chunked check_dataset method for an old dataset
+    that is available in the dataset cache. Chunks of the new dataset are
+    matched by id against the memory-mapped old dataset.
+    """
+
+    old_dataset = load_dataset(filename_old)
+    columns, chunks = read_dataset_chunks(filename_new, CHECK_DATASET_CHUNKSIZE)
+
+    if list(old_dataset.columns) != columns:
+        logger.debug('check_dataset: Columns changed')
+        return True
+
+    if data_type is not None:
+        positions = np.flatnonzero(old_dataset['data_type'].to_numpy() == data_type)
+    else:
+        positions = np.arange(len(old_dataset))
+
+    old_index = pd.Index(old_dataset['id'].to_numpy()[positions])
+
+    rows_new = 0
+    for chunk in _filter_chunks(chunks, data_type):
+        rows_new += len(chunk)
+        if rows_new > len(positions):
+            logger.debug('check_dataset: Number of elements changed')
+            return True
+
+        indexer = old_index.get_indexer(chunk['id'].to_numpy())
+        if (indexer < 0).any():
+            logger.debug('check_dataset: New dataset contains new ids')
+            return True
+
+        old_rows = positions[indexer]
+        for column in columns:
+            old_values = old_dataset[column].to_numpy()[old_rows]
+            new_values = chunk[column].to_numpy()
+            if old_values.dtype.kind in 'USO' or new_values.dtype.kind in 'USO':
+                # Casting to the fixed width string type of the cache could
+                # truncate longer new values
+                old_values = np.asarray(old_values, dtype=str).astype(object)
+                new_values = np.asarray(new_values, dtype=str).astype(object)
+            else:
+                # Numbers are compared at the precision of the cache (float32),
+                # to which they were converted from the same parsed values
+                dtype = np.result_type(old_values.dtype, np.float32)
+                old_values = old_values.astype(dtype)
+                new_values = new_values.astype(dtype)
+            equal = old_values == new_values
+            if old_values.dtype.kind == 'f':
+                equal |= np.isnan(old_values) & np.isnan(new_values)
+            if not equal.all():
+                logger.debug('check_dataset: Values of column %s changed', column)
+                return True
+
+    if rows_new != len(positions):
+        logger.debug('check_dataset: Number of elements changed')
+        return True
+
+    logger.debug('check_dataset: No change detected')
+    return False
+
+
+def _check_dataset_aligned(filename_old, filename_new, data_type=None):
+    """
+    Implementation of the chunked check_dataset method that reads both
+    datasets in aligned chunks. If the rows of both datasets turn out not to
+    be in the same order, the datasets are compared using their fingerprints.
+    """
+
+    columns_old, chunks_old = read_dataset_chunks(filename_old, CHECK_DATASET_CHUNKSIZE)
+    columns_new, chunks_new = read_dataset_chunks(filename_new, CHECK_DATASET_CHUNKSIZE)
+
+    if columns_old != columns_new:
+        logger.debug('check_dataset: Columns changed')
+        return True
+
+    chunks_old = _filter_chunks(chunks_old, data_type)
+    chunks_new = _filter_chunks(chunks_new, data_type)
+    buffer_old = next(chunks_old, None)
+    buffer_new = next(chunks_new, None)
+
+    while buffer_old is not None and buffer_new is not None:
+        n = min(len(buffer_old), len(buffer_new))
+        block_old = buffer_old.iloc[:n]
+        block_new = buffer_new.iloc[:n]
+
+        if not np.array_equal(block_old['id'].to_numpy(), block_new['id'].to_numpy()):
+            logger.debug('check_dataset: Rows are not aligned, comparing fingerprints')
+            return _check_dataset_fingerprint(filename_old, filename_new, data_type)
+
+        if not np.array_equal(hash_rows(block_old), hash_rows(block_new)):
+            logger.debug('check_dataset: new dataset does not equal old dataset')
+            return True
+
+        buffer_old = buffer_old.iloc[n:] if n < len(buffer_old) else next(chunks_old, None)
+        buffer_new = buffer_new.iloc[n:] if n < len(buffer_new) else next(chunks_new, None)
+
+    if buffer_old is not None or buffer_new is not None:
+        logger.debug('check_dataset: Number of elements changed')
+        return True
+
+    logger.debug('check_dataset: No change detected')
+    return False
+
+
+def spearman_by_era(eras, targets, predictions):
+    """
+    Computes the Spearman rank correlation between targets and predictions
+    for every era. The ranks of all eras are computed in a single vectorized
+    pass, after which the correlation of each era is computed on a contiguous
+    block of ranks. The result is identical to calling scipy.stats.spearmanr
+    on the rows of each era: eras that contain missing values or constant
+    inputs have a NaN correlation.
+
+    Args:
+        eras: Array-like with the era of each row.
+        targets: Array-like with the target of each row.
+        predictions: Array-like with the prediction of each row.
+
+    Returns:
+        pandas Series mapping era to correlation, in order of first appearance.
+    """
+
+    codes, uniques = pd.factorize(np.asarray(eras, dtype=object))
+    values = pd.DataFrame({'target': np.asarray(targets, dtype=np.float64),
+                           'prediction': np.asarray(predictions, dtype=np.float64)})
+
+    ranks = values.groupby(codes, sort=False).rank(method='average')
+    missing = values.isnull().any(axis=1).to_numpy()
+
+    # Sort rows by era, so that every era is a contiguous block
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+    ranks = np.column_stack((ranks['target'].to_numpy()[order],
+                             ranks['prediction'].to_numpy()[order]))
+    missing = missing[order]
+
+    correlations = np.full(len(uniques), np.nan)
+    for i in range(len(uniques)):
+        block = ranks[bounds[i]:bounds[i + 1]]
+        if len(block) <= 1 or missing[bounds[i]:bounds[i + 1]].any() or \
+                (block[0, 0] == block[:, 0]).all() or (block[0, 1] == block[:, 1]).all():
+            continue
+
+        # Same computation as scipy.stats.spearmanr on the ranks
+        correlations[i] = np.corrcoef(block, rowvar=False)[1, 0]
+
+    return pd.Series(correlations, index=pd.Index(uniques, dtype=object))
+
+
 def wait(seconds):
     """
-    Helper function that waits for a given number of seconds while checking
-    the exit_requested attribute. If exit_requested is set to True, this
-    function will return.
+    Helper function that waits for a given number of seconds using the
+    Numerauto scheduler.
 
     Args:
         seconds: Number of seconds to wait.
+
+    Raises:
+        WaitCancelled: If the wait is cancelled by an interrupt.
     """
 
     logger.debug('wait(%d)', seconds)
-    dt_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc) + datetime.timedelta(seconds=seconds)
-    wait_until(dt_now)
+    get_scheduler().sleep(seconds)
     
 
 def wait_until(timestamp):
     """
-    Helper function that waits until a given datetime timestamp is reached,
-    while checking the exit_requested attribute. If exit_requested is set
-    to True, this function will return.
+    Helper function that waits until a given datetime timestamp is reached
+    using the Numerauto scheduler.
 
     Args:
         timestamp: datetime object indicating the date and time that should
                    be waited until.
+
+    Raises:
+        WaitCancelled: If the wait is cancelled by an interrupt.
     """
     logger.debug('wait_until(%s)', timestamp.astimezone(dateutil.tz.tzlocal()))
-    dt_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
-
-    while (timestamp - dt_now).total_seconds() > 0:
-        time.sleep(min(1,(timestamp - dt_now).total_seconds()))
-        dt_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+    get_scheduler().sleep_until(timestamp)
 
 
 def wait_for_retry(attempt_number, waiting_schedule):
@@ -110,3 +366,66 @@ def wait_for_retry(attempt_number, waiting_schedule):
         raise RuntimeError('wait_for_retry: attempt_number too high')
 
     wait(waiting_schedule[attempt_number])
+
+
+def get_peak_rss():
+    """
+    Get the peak resident set size (the maximum physical memory used) of the
+    current process since it started.
+
+    Returns:
+        Peak resident set size in bytes, or None if not available on this
+        platform.
+    """
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes, except on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Measurement:
+    """
+    Context manager that measures the wall time, the CPU time of the current
+    thread and the peak memory usage of the process during a block of code.
+
+    Attributes:
+        wall_time: Wall time in seconds.
+        cpu_time: CPU time in seconds of the thread that executed the block.
+                  Work done in other threads or processes is not included.
+        peak_rss: Peak resident set size of the process in bytes at the end of
+                  the block (None if not available)
+        peak_rss_increase: Number of bytes by which the block increased the
+                           peak resident set size of the process, which is 0
+                           if the block used less memory than the peak so far.
+    """
+
+    def __init__(self):
+        self.wall_time = None
+        self.cpu_time = None
+        self.peak_rss = None
+        self.peak_rss_increase = None
+
+    def __enter__(self):
+        self._peak_rss = get_peak_rss()
+        self._cpu_time = time.thread_time()
+        self._wall_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wall_time = time.perf_counter() - self._wall_time
+        self.cpu_time = time.thread_time() - self._cpu_time
+        self.peak_rss = get_peak_rss()
+        if self.peak_rss is not None:
+            self.peak_rss_increase = self.peak_rss - self._peak_rss
+        return False
+
+    def to_dict(self):
+        """ Get the measurements as a dictionary for the round report """
+
+        return {'wall_time': round(self.wall_time, 3),
+                'cpu_time': round(self.cpu_time, 3),
+                'peak_rss': self.peak_rss,
+                'peak_rss_increase': self.peak_rss_increase}
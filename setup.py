@@ -33,7 +33,7 @@ if __name__ == "__main__":
         classifiers=classifiers,
         license='GNU General Public License v3',
         package_data={'numerauto': ['LICENSE', 'README.md', 'CHANGELOG.md']},
-        packages=find_packages(),
-        python_requires='>=3',
-        install_requires=["requests", "pytz", "python-dateutil", "pandas", "numerapi"]
+        packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
+        python_requires='>=3.8',
+        install_requires=["requests", "pytz", "python-dateutil", "numpy", "pandas", "numerapi"]
     )
@@ -0,0 +1,216 @@
+"""
+Tests for numerauto.download against a local HTTP server that supports range
+requests, If-Range and ETags.
+"""
+
+import os
+import re
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from numerauto import download
+from numerauto.download import DownloadError, download_file, get_info_filename, read_download_info
+
+
+def _make_content(size, seed=0):
+    """ Deterministic content that differs per seed """
+
+    block = hashlib.sha256(str(seed).encode('ascii')).digest()
+    return (block * (size // len(block) + 1))[:size]
+
+
+def _md5_etag(content):
+    return '"{}"'.format(hashlib.md5(content).hexdigest())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """ Serves the content of the server, with support for Range and If-Range """
+
+    def do_GET(self):
+        server = self.server
+        content, etag = server.content, server.etag
+        server.requests.append({'range': self.headers.get('Range'), 'if_range': self.headers.get('If-Range')})
+
+        start, end, status = 0, len(content), 200
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range') in (None, etag):
+            start = int(match.group(1))
+            end = int(match.group(2)) + 1 if match.group(2) else len(content)
+            status = 206
+        body = content[start:end]
+
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, len(content)))
+        self.end_headers()
+
+        # Simulate a connection that is dropped after fail_after bytes
+        if server.fail_after is not None and len(body) > server.fail_after:
+            body = body[:server.fail_after]
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.set_content(b'', '"empty"')
+
+    def set_content(self, content, etag):
+        self.content = content
+        self.etag = etag
+        self.fail_after = None
+        self.requests = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/dataset.zip'.format(self.server_address[1])
+
+    def handle_error(self, request, client_address):
+        # The client closes connections of stopped ranges
+        pass
+
+
+@pytest.fixture
+def server():
+    server = _Server()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def session():
+    with requests.Session() as session:
+        yield session
+
+
+def _read(filename):
+    with open(filename, 'rb') as fp:
+        return fp.read()
+
+
+@pytest.mark.parametrize('connections', [1, 4])
+def test_full_download(server, session, tmp_path, connections):
+    content = _make_content(3 * download.DOWNLOAD_MIN_RANGE_SIZE)
+    server.set_content(content, _md5_etag(content))
+    filename = tmp_path / 'dataset.zip'
+
+    info = download_file(session, server.url, filename, timeout=10, connections=connections)
+
+    assert _read(filename) == content
+    assert info['complete'] and info['md5'] == hashlib.md5(content).hexdigest()
+    assert read_download_info(filename) == info
+    assert not os.path.exists(str(filename) + '.part')
+    assert not os.path.exists(get_info_filename(str(filename) + '.part'))
+
+
+def test_resume_single_stream(server, session, tmp_path):
+    content = _make_content(1000000)
+    server.set_content(content, _md5_etag(content))
+    filename = tmp_path / 'dataset.zip'
+
+    server.fail_after = 300000
+    with pytest.raises(requests.RequestException):
+        download_file(session, server.url, filename, timeout=10)
+    offset = os.path.getsize(str(filename) + '.part')
+    assert 0 < offset <= 300000
+
+    server.fail_after = None
+    download_file(session, server.url, filename, timeout=10)
+
+    assert _read(filename) == content
+    assert server.requests[-1] == {'range': 'bytes={}-'.format(offset), 'if_range': server.etag}
+
+
+def test_resume_parallel(server, session, tmp_path):
+    size = 3 * download.DOWNLOAD_MIN_RANGE_SIZE
+    content = _make_content(size)
+    server.set_content(content, _md5_etag(content))
+    filename = tmp_path / 'dataset.zip'
+
+    server.fail_after = 200000
+    with pytest.raises(requests.RequestException):
+        download_file(session, server.url, filename, timeout=10, connections=3)
+
+    ranges = read_download_info(str(filename) + '.part')['ranges']
+    downloaded = sum(x[2] for x in ranges)
+    assert downloaded > 0
+
+    server.fail_after = None
+    server.requests = []
+    download_file(session, server.url, filename, timeout=10, connections=3)
+
+    assert _read(filename) == content
+    # Only the remaining data is requested, besides the first byte for the
+    # remote information
+    requested = 0
+    for request in server.requests[1:]:
+        start, end = re.fullmatch(r'bytes=(\d+)-(\d+)', request['range']).groups()
+        requested += int(end) - int(start) + 1
+    assert requested == size - downloaded
+
+
+def test_changed_etag_restarts_download(server, session, tmp_path):
+    old_content = _make_content(1000000, seed=1)
+    new_content = _make_content(1000000, seed=2)
+    server.set_content(old_content, '"v1"')
+    filename = tmp_path / 'dataset.zip'
+
+    server.fail_after = 300000
+    with pytest.raises(requests.RequestException):
+        download_file(session, server.url, filename, timeout=10)
+    offset = os.path.getsize(str(filename) + '.part')
+    stale_info = download.get_remote_info(session, server.url, timeout=10)
+
+    # The file changes between the remote information request and the
+    # download, so If-Range makes the server return the full new file
+    server.set_content(new_content, '"v2"')
+    download_file(session, server.url, filename, remote_info=stale_info, timeout=10)
+
+    assert _read(filename) == new_content
+    assert server.requests[-1] == {'range': 'bytes={}-'.format(offset), 'if_range': '"v1"'}
+
+
+def test_changed_remote_file_is_downloaded_from_start(server, session, tmp_path):
+    content = _make_content(1000000, seed=1)
+    server.set_content(content, '"v1"')
+    filename = tmp_path / 'dataset.zip'
+
+    server.fail_after = 300000
+    with pytest.raises(requests.RequestException):
+        download_file(session, server.url, filename, timeout=10)
+
+    new_content = _make_content(1000000, seed=2)
+    server.set_content(new_content, '"v2"')
+    info = download_file(session, server.url, filename, timeout=10)
+
+    assert _read(filename) == new_content
+    assert info['etag'] == '"v2"'
+    assert server.requests[-1] == {'range': None, 'if_range': None}
+
+
+def test_md5_mismatch_removes_part_file(server, session, tmp_path):
+    content = _make_content(1000000)
+    server.set_content(content, _md5_etag(b'other content'))
+    filename = tmp_path / 'dataset.zip'
+
+    with pytest.raises(DownloadError):
+        download_file(session, server.url, filename, timeout=10)
+
+    assert not os.path.exists(filename)
+    assert not os.path.exists(str(filename) + '.part')
+    assert not os.path.exists(get_info_filename(str(filename) + '.part'))